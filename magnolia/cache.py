@@ -0,0 +1,289 @@
+import os
+import hashlib
+import tempfile
+import threading
+import cPickle as pickle
+
+import css
+import html
+from css._abstract import get_instances, reserve_instance_numbers
+
+class TreeCache(object):
+    """ parsed and styled element trees, kept on disk
+
+    Each entry is filed under a key made from the document it was parsed
+    from (see 'get_key'), and lists the stylesheets it was styled with along
+    with hashes of their contents. An entry is only loaded while all of
+    those stylesheets are unchanged.
+
+    An entry is a short header followed by two pickles: the list of
+    (stylesheet path, content hash) pairs, then the string written by
+    Element.serialize. As entries are unpickled, the directory must only be
+    writable by those who are trusted to run code """
+    MAGIC = "MGTC"
+    # raised whenever trees are styled differently, so trees styled by
+    # older code are not loaded
+    VERSION = 3
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    @staticmethod
+    def get_hash(text):
+        return hashlib.sha1(text).hexdigest()
+
+    @classmethod
+    def get_file_hash(cls, fname):
+        """ returns the hash of the contents of 'fname', or None if it can not
+        be read """
+        try:
+            with open(fname, 'rb') as f:
+                return cls.get_hash(f.read())
+        except IOError:
+            return None
+
+    @classmethod
+    def get_key(cls, document, *settings):
+        """ returns the key for the document text 'document', as read with
+        'settings' (anything that changes how it is parsed or where its
+        stylesheets are found) """
+        key = hashlib.sha1("{}:{}".format(cls.VERSION, html.SERIAL_VERSION))
+        for setting in settings:
+            key.update("\0{}".format(setting))
+        key.update("\0\0")
+        key.update(document)
+        return key.hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key+".tree")
+
+    def load(self, key):
+        """ returns the element tree stored under 'key', or None if there is
+        none or any of its stylesheets have changed """
+        try:
+            with open(self._get_path(key), 'rb') as f:
+                if f.read(len(self.MAGIC))!=self.MAGIC:
+                    return None
+                version, sources = pickle.load(f)
+                if version!=self.VERSION:
+                    return None
+                for fname, content_hash in sources:
+                    if self.get_file_hash(fname)!=content_hash:
+                        return None
+                return html.Element.deserialize(pickle.load(f))
+        except Exception:
+            # an entry that can not be read (for example one pickled with 
+            # classes that have since changed) is treated as missing
+            return None
+
+    def store(self, key, element_tree, sources):
+        """ stores 'element_tree' under 'key'. 'sources' is a list of the
+        (path, content hash) of every stylesheet the tree was styled with """
+        # the entry is written to a temporary file first, so a reader never
+        # sees half of it
+        handle, temp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(self.MAGIC)
+                pickle.dump((self.VERSION, list(sources)), f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(element_tree.serialize(), f, pickle.HIGHEST_PROTOCOL)
+            path = self._get_path(key)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+class StyleSheetCache(object):
+    """ parsed stylesheets, kept on disk
+
+    Each entry is filed under the absolute path of the stylesheet, its
+    modification time and a hash of its contents, so an entry is never
+    loaded for a stylesheet that has changed. Entries that are no longer
+    used are not removed straight away; instead, once the entries take up
+    more than 'max_size' bytes, the least recently used ones are removed
+    until they fit again.
+
+    An entry is a short header followed by a pickle of the StyleSheet. Like
+    TreeCache, the directory must be trusted, as entries are unpickled """
+    MAGIC = "MGSC"
+    VERSION = 1
+    EXTENSION = ".sheet"
+
+    def __init__(self, directory, max_size=64*1024*1024):
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    @classmethod
+    def get_key(cls, path, text, content_hash=None):
+        """ returns the key for the stylesheet at 'path' with contents 'text'.
+        'content_hash' is the hash of 'text' from TreeCache.get_hash, if it
+        is already known """
+        if content_hash is None:
+            content_hash = TreeCache.get_hash(text)
+        path = os.path.abspath(path)
+        return TreeCache.get_hash("{}\0{!r}\0{}\0{}".format(cls.VERSION,
+            os.path.getmtime(path), content_hash, path))
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key+self.EXTENSION)
+
+    @staticmethod
+    def _renumber(stylesheet):
+        # styles are ordered by when they were made, so the loaded ones are
+        # given new numbers, in the same order, as if they had just been parsed
+        items = [stylesheet]+get_instances(stylesheet._items)
+        first = min(item._instance_no for item in items)
+        last = max(item._instance_no for item in items)
+        offset = reserve_instance_numbers(last-first+1)-first
+        for item in items:
+            item._instance_no += offset
+
+    def load(self, key):
+        """ returns the stylesheet stored under 'key', or None if there is
+        none """
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                if f.read(len(self.MAGIC))!=self.MAGIC:
+                    return None
+                version, stylesheet = pickle.load(f)
+            if version!=self.VERSION:
+                return None
+            # the modification time marks when an entry was last used
+            os.utime(path, None)
+        except Exception:
+            # as in TreeCache.load, an entry that can not be read is missing
+            return None
+        self._renumber(stylesheet)
+        return stylesheet
+
+    def store(self, key, stylesheet):
+        """ stores 'stylesheet' under 'key', then removes the least recently
+        used entries if the cache has grown too large """
+        handle, temp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(self.MAGIC)
+                pickle.dump((self.VERSION, stylesheet), f, pickle.HIGHEST_PROTOCOL)
+            path = self._get_path(key)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """ removes the least recently used entries until they take up no
+        more than 'max_size' bytes """
+        entries = []
+        total_size = 0
+        for fname in os.listdir(self.directory):
+            if fname.endswith(self.EXTENSION):
+                path = os.path.join(self.directory, fname)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_size += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size<=self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+
+    def parse(self, path, text, content_hash=None):
+        """ returns the stylesheet at 'path' with contents 'text', parsed
+        or loaded from the cache """
+        key = self.get_key(path, text, content_hash)
+        stylesheet = self.load(key)
+        if stylesheet is None:
+            stylesheet = css.StyleSheet.parse(text, src=path)
+            self.store(key, stylesheet)
+        return stylesheet
+
+
+class StyleSheetRegistry(object):
+    """ parsed stylesheets, kept in memory for the life of the process
+
+    Each entry is filed under the resolved path of the stylesheet, and is
+    parsed again once the file's modification time or size changes. The
+    stylesheets handed out are shared by everything that asks for the same
+    file, so they must not be changed; Element.apply_styles only reads them.
+    The registry can be used from several threads at once """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "StyleSheetRegistry({} stylesheets, {} hits, {} misses)".format(
+            len(self._entries), self.hits, self.misses)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, path, stylesheet_cache=None):
+        """ returns the stylesheet at 'path' and the hash of its contents
+        from TreeCache.get_hash. The stylesheet is None if the file is
+        empty. If it has to be parsed, it is parsed through
+        'stylesheet_cache' when one is given. Raises IOError if the file can
+        not be read """
+        key = os.path.realpath(os.path.abspath(path))
+        try:
+            stat = os.stat(key)
+        except OSError as e:
+            raise IOError(str(e))
+        version = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0]==version:
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+        # stylesheets are parsed outside of the lock, so a large one does not
+        # hold up other threads. Two threads may both parse the same one, in
+        # which case the last to finish is kept. The file is read as bytes, so
+        # its hash matches TreeCache.get_file_hash whatever its line endings
+        with open(key, 'rb') as f:
+            text = f.read()
+        content_hash = TreeCache.get_hash(text)
+        stylesheet = None
+        if text:
+            if stylesheet_cache is not None:
+                stylesheet = stylesheet_cache.parse(key, text, content_hash)
+            else:
+                stylesheet = css.StyleSheet.parse(text, src=key)
+        with self._lock:
+            self._entries[key] = (version, stylesheet, content_hash)
+        return stylesheet, content_hash
+
+    def discard(self, path):
+        """ forgets the stylesheet at 'path', if there is one """
+        with self._lock:
+            self._entries.pop(os.path.realpath(os.path.abspath(path)), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+# every HTMLPreprocessor reads its linked stylesheets through this registry
+STYLESHEETS = StyleSheetRegistry()
@@ -1,2 +1,3 @@
 from static import Style, Selector
-from containers import StyleSheet
\ No newline at end of file
+from containers import StyleSheet
+from _abstract import intern_symbol
\ No newline at end of file
@@ -2,50 +2,7 @@ import re
 import abc
 from os import path
 import string
-
-
-class Trie(object):
-    # __slots__ = ["trie","_seg_d","_seg_i"]
-    def __init__(self, *items):
-        self.trie = {}
-        self._seg_d = self.trie
-        self._seg_i = 0
-        if items:
-            for i in items:
-                self.add(i)
-
-    def add(self, item):
-        cur_d = self.trie
-        for n,c in enumerate(item):
-            if not c in cur_d:
-                cur_d[c]={}
-            cur_d = cur_d[c]
-
-    def seg_contains(self,c):
-        # if isinstance(self._seg_d, dict):
-        if not c in self._seg_d:
-            self.seg_reset()
-            return False
-        elif len(self._seg_d[c])<1:
-            self.seg_reset()
-            return True
-        else:
-            self._seg_d = self._seg_d[c]
-
-    def seg_reset(self):
-        self._seg_d = self.trie
-        self._seg_i = 0
-
-    def contains(self, item):
-        cur_d = self.trie
-        for n,c in enumerate(item):
-            if not c in cur_d:
-                return False
-            elif len(cur_d[c])<1:
-                return True
-            else:
-                cur_d = cur_d[c]
-        return False
+import threading
 
 
 AT_RULES = ["charset","import","namespace","media","supports","document",
@@ -88,8 +45,50 @@ PSEUDO_ELEMENTS = ["cue","after","before","marker","backdrop","selection",
                    "first-line","placeholder","first-letter","grammar-error",
                    "spelling-error"]
 
-PC_TRIE = Trie(*PSEUDO_CLASSES)
-PE_TRIE = Trie(*PSEUDO_ELEMENTS)
+# tag names, attribute names and class names are interned so html elements
+# and selectors can usually compare them by identity. Interned strings are
+# freed once nothing uses them, so this does not grow with every name seen
+def intern_symbol(symbol):
+    """ returns the shared copy of 'symbol'. Names that are not plain ascii
+    can not be interned, and are returned as they are """
+    try:
+        return intern(str(symbol))
+    except UnicodeEncodeError:
+        return symbol
+
+
+# styles are applied in the order of their instance numbers. Copies keep the
+# number of what they were copied from, so these let a copy be moved to
+# another place in that order
+def get_instances(items):
+    """ returns 'items' and, for at-rules, all their children """
+    instances = list(items)
+    i = 0
+    while i<len(instances):
+        # only at-rules have children
+        instances.extend(getattr(instances[i], "children", ()))
+        i += 1
+    return instances
+
+_instance_lock = threading.Lock()
+
+def reserve_instance_numbers(count, minimum=0):
+    """ returns the first of 'count' instance numbers that no other CSS
+    object is given, none of which are below 'minimum'. All instance numbers
+    are handed out through this, so it can be called from several threads at
+    once. A 'count' of 0 returns the next number to be handed out """
+    with _instance_lock:
+        first = max(CSSAbstract._instance_counter, minimum)
+        CSSAbstract._instance_counter = first+count
+    return first
+
+def shift_instance_numbers(item, offset):
+    """ adds 'offset' to the instance numbers of 'item' and all its children,
+    then returns it """
+    if offset:
+        for instance in get_instances((item,)):
+            instance._instance_no += offset
+    return item
 
 
 class CSSParserError(Exception):
@@ -141,8 +140,7 @@ class CSSAbstract():
     _instance_counter = 0
 
     def __init__(self):
-        self._instance_no = CSSAbstract._instance_counter
-        CSSAbstract._instance_counter += 1
+        self._instance_no = reserve_instance_numbers(1)
 
     def __cmp__(self, other):
         if not isinstance(other, CSSAbstract):
@@ -161,81 +159,78 @@ class CSSAbstract():
     def __lte__(self,other):
         return self.__cmp__(other)<=0
 
+    CSS_WHITESPACE = re.compile(r"\s*")
+
+    # everything that can end a rule or change how the text after it is read
+    CSS_SYNTAX = re.compile(r"/\*|[\\\"'@;{}]")
+
+    # the rest of a string once its opening quote has been read. A string
+    # that is never closed runs to the end of the input
+    CSS_STRINGS = {
+        '"': re.compile(r'(?:[^"\\]|\\.)*"?', re.DOTALL),
+        "'": re.compile(r"(?:[^'\\]|\\.)*'?", re.DOTALL),
+    }
+
     @classmethod
     def _parse_css(cls, inpt,src=None):
-        def unescaped_char(sub_string,i):
-            return inpt[i]==sub_string and (i==0 or (i>0 and inpt[i-1]!="\\"))
-        inpt = inpt.strip()
-        while inpt:
-            # i = hs = he = ts = te = 0
-            k=i=0
-            head = tail = ""
-            in_comment = False
-            at_rule = False
-            string_start = None
-            while i<len(inpt):
-                if in_comment:
-                    if inpt[i-2:i]=="*/":
-                        k=i
-                        in_comment = False
-                else:
-                    if inpt[i:i+2]=="/*":
-                        head += inpt[k:i]
-                        in_comment = True
-                        continue
-                    elif unescaped_char('"',i) or unescaped_char("'",i):
-                        # strings are treated somewhat like comments,
-                        # in that css constructs inside them are ignored
-                        if string_start:
-                            if inpt[i]==string_start:
-                                string_start = None
-                        else:
-                            string_start = inpt[i]    
-                    elif inpt[i]=='{':
-                        break
-                    elif inpt[i]=='@':
-                        at_rule=True
-                    elif at_rule and inpt[i]==";":
-                        break
-                i+=1
-            head += inpt[k:i]
-            if i>=len(inpt):
-                raise StopIteration
-            # i is now at first valid { or ;
-            if inpt[i]==";":
-                yield CSSToken(inpt[:i+1],head,"",i+1, False)
-                inpt = inpt[i+1:]
+        """ yields a CSSToken for each top level rule in 'inpt'.
+
+        The input is read once from start to end. Comments are left out of the
+        heads and tails, and anything inside a string or escaped with a
+        backslash is read as plain text. A block that is still open at the end
+        of the input is closed there """
+        length = len(inpt)
+        pieces = [] # the current head or tail, less its comments
+        head = ""
+        depth = 0
+        at_rule = False
+        start = k = i = cls.CSS_WHITESPACE.match(inpt).end()
+        while True:
+            match = cls.CSS_SYNTAX.search(inpt, i)
+            if match is None:
+                break
+            i = match.start()
+            char = match.group()
+            if char=="/*":
+                pieces.append(inpt[k:i])
+                end = inpt.find("*/", i+2)
+                k = i = end+2 if end>=0 else length
                 continue
-            # he = i
-            k = i+1 if i!=len(inpt)-1 else i
-            nest_layer = 1
-            while i<len(inpt):
-                i += 1
-                if in_comment:
-                    if inpt[i-2:i]=="*/":
-                        k=i
-                        in_comment = False
-                else:
-                    if inpt[i:i+2]=="/*":
-                        tail+=inpt[k:i]
-                        in_comment=True
-                        continue
-                    elif unescaped_char('"',i) or unescaped_char("'",i):
-                        if string_start:
-                            if inpt[i]==string_start:
-                                string_start = None
-                        else:
-                            string_start = inpt[i]  
-                    elif not string_start:
-                        if inpt[i]=="}" and (i==0 or (i>0 and inpt[i-1]!="\\")):
-                            nest_layer -= 1
-                            if nest_layer<=0:
-                                break
-                        elif inpt[i]=="{" and (i==0 or (i>0 and inpt[i-1]!="\\")):
-                            nest_layer +=1
-            tail += inpt[k:i]
-            yield CSSToken(inpt[:i+1].strip(),head.strip(),tail.strip(),i,True)
-            inpt = inpt[i+1:].strip()
+            elif char=="\\":
+                i += 2
+                continue
+            elif char in cls.CSS_STRINGS:
+                i = cls.CSS_STRINGS[char].match(inpt, i+1).end()
+                continue
+            i += 1
+            if depth==0:
+                if char=="{":
+                    pieces.append(inpt[k:i-1])
+                    head = "".join(pieces).strip()
+                    pieces = []
+                    k = i
+                    depth = 1
+                elif char=="@":
+                    at_rule = True
+                elif char==";" and at_rule:
+                    pieces.append(inpt[k:i-1])
+                    yield CSSToken(inpt[start:i], "".join(pieces).strip(), "", i-start, False)
+                    pieces = []
+                    at_rule = False
+                    start = k = i = cls.CSS_WHITESPACE.match(inpt, i).end()
+            elif char=="{":
+                depth += 1
+            elif char=="}":
+                depth -= 1
+                if depth==0:
+                    pieces.append(inpt[k:i-1])
+                    yield CSSToken(inpt[start:i], head, "".join(pieces).strip(), i-1-start, True)
+                    pieces = []
+                    at_rule = False
+                    start = k = i = cls.CSS_WHITESPACE.match(inpt, i).end()
+        if depth>0:
+            pieces.append(inpt[k:])
+            yield CSSToken(inpt[start:].strip(), head, "".join(pieces).strip(), length-start, True)
 
     @abc.abstractmethod
     def get_copy(self):
@@ -263,109 +258,101 @@ class StaticAbstract():
                                     sorted(PSEUDO_CLASSES+PSEUDO_ELEMENTS,key=lambda i:len(i),
                                         reverse=True))),re.DOTALL)
 
+    SELECTOR_NAME = re.compile(r"-?[_a-zA-Z][_a-zA-Z0-9-]*")
+    SELECTOR_NAME_START = "-_"+string.ascii_letters
+    SELECTOR_WHITESPACE = re.compile(r"\s+")
+    SELECTOR_PARENTHESES = re.compile(r"[()]")
+
+    # a pseudo-class is read up to the end of the first name it matches, so a
+    # name that starts a longer one (like 'first' in 'first-child') is only
+    # matched as part of the longer name
+    PSEUDO_CLASS_NAME = re.compile("|".join(name for name in PSEUDO_CLASSES
+        if not any(other!=name and other.startswith(name) for other in PSEUDO_CLASSES)))
+
+    @classmethod
+    def _skip_parentheses(cls, inpt, i):
+        """ returns the position after the parenthesis that closes the one at
+        'i' """
+        depth = 0
+        for match in cls.SELECTOR_PARENTHESES.finditer(inpt, i):
+            if match.group()=="(":
+                depth += 1
+            else:
+                depth -= 1
+                if depth==0:
+                    return match.end()
+        raise CSSParserError("Unclosed parenthesis at position {}.".format(i))
+
     @classmethod
     def _tokenize_selector(cls,inpt):
-        matches = []
-        k = i = 0
-        cur_match = SelectorToken()
-        while i<len(inpt):
-            if inpt[i] in "#.":
-                if (cur_match.type or cur_match.name or cur_match.attribute
-                    or cur_match.pseudo_class):
-                    matches.append(cur_match)
-                    cur_match=SelectorToken()
-                cur_match.type=inpt[i]
-
-            elif inpt[i]=="[":
-                while i<len(inpt) and inpt[i]!=']':
-                    i+=1
-                cur_match.attribute = inpt[k:i+1]
-
-            elif inpt[i] in "-_"+string.ascii_letters and not cur_match.name:
-                if inpt[i]=='-':
-                    i+=1
-                if not inpt[i] in "_"+string.ascii_letters:
-                        raise CSSParserError("Malformed class name at position {}.".format(i))
-                i+=1
-                while i<len(inpt) and inpt[i] in "_-"+string.ascii_letters+string.digits:
-                    i+=1
-                cur_match.name=inpt[k:i]
-                k=i
+        """ returns a SelectorToken for each compound selector in 'inpt', in
+        order. Each token's 'conn_type' is the combinator that follows it.
+
+        'inpt' is read once, and all of the state is kept in local variables,
+        so several threads can tokenize at once """
+        tokens = []
+        token = SelectorToken()
+        length = len(inpt)
+        i = 0
+        while i<length:
+            char = inpt[i]
+            if char in "#.":
+                if token.type or token.name or token.attribute or token.pseudo_class:
+                    tokens.append(token)
+                    token = SelectorToken()
+                token.type = char
+
+            elif char=="[":
+                end = inpt.find("]", i)
+                if end<0:
+                    end = length
+                token.attribute = inpt[i:end+1]
+                i = end
+
+            elif char in cls.SELECTOR_NAME_START and not token.name:
+                match = cls.SELECTOR_NAME.match(inpt, i)
+                if match is None:
+                    raise CSSParserError("Malformed class name at position {}.".format(i+1))
+                token.name = match.group()
+                i = match.end()
                 continue
 
-            elif inpt[i] in "*":
-                cur_match.name=inpt[i]
-
-            elif inpt[i]==":":
-                k=i
-                i+=1
-                if inpt[i]==":":
-                    i+=1
-                cls_res = None
-                while cls_res==None and i<len(inpt):
-                    cls_res = PC_TRIE.seg_contains(inpt[i])
-                    i+=1
-                PC_TRIE.seg_reset()
-                if cls_res:
-                    if i<len(inpt) and inpt[i]=="(":
-                        p_count = 1
-                        while p_count>0 and i<len(inpt):
-                            i+=1
-                            if inpt[i]=="(":
-                                p_count+=1
-                            elif inpt[i]==")":
-                                p_count-=1
-                        i+=1
-                    if cur_match.pseudo_class:
-                        matches.append(cur_match)
-                        cur_match = SelectorToken()
-                    cur_match.pseudo_class = inpt[k:i]
-                    k=i
+            elif char=="*":
+                token.name = char
+
+            elif char==":":
+                start = i
+                i += 2 if inpt.startswith("::", i) else 1
+                match = cls.PSEUDO_CLASS_NAME.match(inpt, i)
+                if match:
+                    i = match.end()
+                    if i<length and inpt[i]=="(":
+                        i = cls._skip_parentheses(inpt, i)
+                    if token.pseudo_class:
+                        tokens.append(token)
+                        token = SelectorToken()
+                    token.pseudo_class = inpt[start:i]
                     continue
-                if cur_match.name or cur_match.attribute or cur_match.pseudo_class:
-                    ele_res = None
-                    i=k
-                    while ele_res==None and i<len(inpt):
-                        ele_res = PE_TRIE.seg_contains(inpt[i])
-                        i+=1
-                    PE_TRIE.seg_reset()
-                    if ele_res:
-                        if i<len(inpt) and inpt[i]=="(":
-                            p_count = 1
-                            while p_count>0 and i<len(inpt):
-                                i+=1
-                                if inpt[i]=="(":
-                                    p_count+=1
-                                elif inpt[i]==")":
-                                    p_count-=1
-                            i+=1
-                        cur_match.pseudo_element = inpt[k:i]
-                        k=i
-                        continue
-                i=k
-
-            elif inpt[i] in ">+~":
-                cur_match.conn_type=inpt[i]
-                matches.append(cur_match)
-                cur_match = SelectorToken()
-
-            elif inpt[i] in string.whitespace:
-                while i<len(inpt) and inpt[i] in string.whitespace:
-                    i+=1
-                k=i
-                if (i>len(inpt) or (
-                  (cur_match.name or cur_match.attribute or cur_match.pseudo_class) 
-                  and not inpt[i] in ">+~")):
-                    cur_match.conn_type = ' '
-                    matches.append(cur_match)
-                    cur_match = SelectorToken()
-                    k=i
+                # anything else after a colon is skipped
+                i = start
+
+            elif char in ">+~":
+                token.conn_type = char
+                tokens.append(token)
+                token = SelectorToken()
+
+            elif char in string.whitespace:
+                i = cls.SELECTOR_WHITESPACE.match(inpt, i).end()
+                if ((token.name or token.attribute or token.pseudo_class)
+                  and i<length and not inpt[i] in ">+~"):
+                    token.conn_type = ' '
+                    tokens.append(token)
+                    token = SelectorToken()
                 continue
-            i+=1
-            k=i
-        if cur_match:
-            matches.append(cur_match)
-        return matches
+            i += 1
+        if token:
+            tokens.append(token)
+        return tokens
 
     @abc.abstractmethod
     def match(self, element):
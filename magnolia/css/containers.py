@@ -3,7 +3,8 @@ from bisect import insort as sorted_insert
 from static import Style
 from dynamic import AtRule, AtQuery
 from _abstract import (CSSAbstract, ContainerAbstract, 
-                      StaticAbstract, CSSParserError)
+                      StaticAbstract, CSSParserError,
+                      get_instances, shift_instance_numbers)
 
 class StyleSheet(CSSAbstract, ContainerAbstract, StaticAbstract):
     def __init__(self):
@@ -115,24 +116,44 @@ class StyleSheet(CSSAbstract, ContainerAbstract, StaticAbstract):
                 for style in self._style_map[style_stub]:
                     if style.match(element):
                         matching.append(style)
+        # the style map is in no particular order, so the styles are put back
+        # in the order they were parsed in
+        matching.sort()
         for at_rule in self._at_rules:
             child_match = at_rule.match(element)
             if child_match:
                 matching.append(child_match)
         return matching
 
-    def merge(self, other):
+    def get_instance_range(self):
+        """ returns the lowest and highest instance numbers of the items in
+        this stylesheet, or None if it is empty """
+        numbers = [item._instance_no for item in get_instances(self._items)]
+        if not numbers:
+            return None
+        return min(numbers), max(numbers)
+
+    def _merge_item(self, item, offset):
+        if item in self._items:
+            existing = self._items[self._items.index(item)]
+            if isinstance(existing, AtRule):
+                existing.merge(item, offset)
+            else:
+                existing.merge(item)
+        else:
+            self.add(shift_instance_numbers(item.get_copy(), offset))
+
+    def merge(self, other, offset=0):
+        """ merges 'other' into this stylesheet. Items that are copied in
+        have 'offset' added to their instance numbers, which sets where they
+        go in the order styles are applied in """
+        # items are copied in, as the ones here are changed by later merges
+        # and 'other' may be shared (see cache.StyleSheetRegistry)
         if isinstance(other, StyleSheet):
             for item in other._items:
-                if item in self._items:
-                    self._items[self._items.index(item)].merge(item)
-                else:
-                    self.add(item)
+                self._merge_item(item, offset)
         elif isinstance(other, (Style,AtRule)):
-            if other in self._items:
-                self._items[self._items.index(other)].merge(other)
-            else:
-                self.add(other)
+            self._merge_item(other, offset)
 
     def render(self,flags=0):
         if flags&CSSAbstract.INLINE and flags&CSSAbstract.AT_RULES:
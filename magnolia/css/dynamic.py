@@ -3,7 +3,8 @@ from bisect import insort as sorted_insert
 
 from static import Style
 from _abstract import (CSSAbstract, StaticAbstract, DynamicAbstract, 
-                       ContainerAbstract, CSSParserError)
+                       ContainerAbstract, CSSParserError,
+                       shift_instance_numbers)
 
 class AtQuery(DynamicAbstract):
     """ the stuff between the @ and the { """
@@ -136,13 +137,17 @@ class AtRule(CSSAbstract, StaticAbstract, DynamicAbstract, ContainerAbstract):
             return self._match_styles(element)
         return None
 
-    def merge(self, other):
+    def merge(self, other, offset=0):
         if self==other:
             for child in other.children:
                 if child in self.children:
-                    self.children[self.children.index(child)].merge(child)
+                    existing = self.children[self.children.index(child)]
+                    if isinstance(existing, AtRule):
+                        existing.merge(child, offset)
+                    else:
+                        existing.merge(child)
                 else:
-                    self.add(child)
+                    self.add(shift_instance_numbers(child.get_copy(), offset))
 
     @staticmethod
     def _indent(s):
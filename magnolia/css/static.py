@@ -1,7 +1,10 @@
 import re
+import threading
+from collections import OrderedDict
 
 from _abstract import INHERITED_ATTRIBUTES, PSEUDO_ELEMENTS
 from _abstract import CSSAbstract, StaticAbstract, CSSParserError
+from _abstract import intern_symbol
 
 
 class Property():
@@ -192,6 +195,21 @@ class Pseudo(StaticAbstract):
     def __init__(self, name, argument=None):
         self.name = name
         self.argument = argument
+        # the text of 'argument' when it is an equation (see '_parse_equation')
+        self._equation = None
+
+    def __getstate__(self):
+        # an equation is kept as a function, which can not be pickled, so the
+        # text it was made from is pickled instead
+        state = self.__dict__.copy()
+        if self._equation is not None:
+            state["argument"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._equation is not None:
+            self.argument = self._parse_equation(self._equation)
 
     def __eq__(self,other):
         return isinstance(other, Pseudo) and \
@@ -204,7 +222,9 @@ class Pseudo(StaticAbstract):
         return 1
 
     def get_copy(self):
-        return Pseudo(self.name, self.argument)
+        new_pseudo = Pseudo(self.name, self.argument)
+        new_pseudo._equation = self._equation
+        return new_pseudo
 
     @staticmethod
     def _parse_equation(inpt):
@@ -239,14 +259,18 @@ class Pseudo(StaticAbstract):
     def parse(cls, inpt):
         tokenized = re.finditer(cls.PSEUDO_TOKENIZER, inpt).next()
         name = tokenized.group("name")
+        equation = None
         if tokenized.group("argument") != None:
             if name=="nth-child" or name=="nth-of-type":
-                argument = cls._parse_equation(tokenized.group("argument").strip())
+                equation = tokenized.group("argument").strip()
+                argument = cls._parse_equation(equation)
             else:
                 argument = Selector.parse(tokenized.group("argument").strip())
         else:
             argument = None
-        return Pseudo(name, argument)
+        new_pseudo = Pseudo(name, argument)
+        new_pseudo._equation = equation
+        return new_pseudo
 
     def match(self, element):
         # unfortunately, as each pseudo-class has unique behaviour, each one
@@ -265,48 +289,47 @@ class Pseudo(StaticAbstract):
             return element.get_empty()
         elif self.name == "first-child":
             if element.has_parent():
-                return element.get_parent().get_elements().index(element)==0
+                return element.get_index()==0
             else:
                 return True
         elif self.name == "first-of-type":
             if element.has_parent():
-                return element.get_parent().get_elements(element.name).index(element)==0
+                return element.get_index(True)==0
             else:
                 return True
         elif self.name == "last-child":
             if element.has_parent():
-                children = element.get_parent().get_elements()
-                return children.index(element)==len(children)-1
+                return element.get_index()==element.get_parent().get_element_count()-1
             else:
                 return True
         elif self.name == "last-of-type":
             if element.has_parent():
-                children = element.get_parent().get_elements(element.name)
-                return children.index(element)==len(children)-1
+                return (element.get_index(True)==
+                        element.get_parent().get_element_count(element.name)-1)
             else:
                 return True
         elif self.name == "nth-child":
             if element.has_parent():
-                children = element.get_parent().get_elements()
-                return self.argument(children.index(element)+1)
+                index = element.get_index()
+                return index is not None and self.argument(index+1)
             else:
                 return True
         elif self.name == "nth-of-type":
             if element.has_parent():
-                children = element.get_parent().get_elements(element.name)
-                return self.argument(children.index(element)+1)
+                index = element.get_index(True)
+                return index is not None and self.argument(index+1)
             else:
                 return True
         elif self.name == "only-child":
             if element.has_parent():
-                children = element.get_parent().get_elements()
-                return len(children)==1 and element in children
+                return (element.get_parent().get_element_count()==1 and 
+                        element.get_index() is not None)
             else:
                 return True
         elif self.name == "only-of-type":
             if element.has_parent():
-                children = element.get_parent().get_elements(element.name)
-                return len(children)==1 and element in children
+                return (element.get_parent().get_element_count(element.name)==1 and 
+                        element.get_index() is not None)
             else:
                 return True
         elif self.name == "not":
@@ -336,12 +359,21 @@ class Element(StaticAbstract):
 
     def __init__(self, element_tag, element_type, attribute_filter=None, 
                        pseudo_class=None,pseudo_element=None):
-        self.element_tag = element_tag
+        self.element_tag = intern_symbol(element_tag)
         self.element_type = element_type
+        # html elements keep an interned, lowercased 'tag_name' to compare to
+        self._tag_name = intern_symbol(element_tag.lower())
         self.attribute_filter = attribute_filter
         self.pseudo_class = pseudo_class
         self.pseudo_element = pseudo_element
 
+    def __setstate__(self, state):
+        # the tag names are compared by identity first, so an unpickled
+        # element should use the interned copies
+        self.__dict__.update(state)
+        self.element_tag = intern_symbol(self.element_tag)
+        self._tag_name = intern_symbol(self._tag_name)
+
     def __repr__(self):
         return self.render(False)
 
@@ -401,29 +433,34 @@ class Element(StaticAbstract):
         # again, there should only be one element passed anyway
         # P.S RE:'again', I wrote the parse methods starting at the bottom
         #                 of this file
-        tokenized = cls._tokenize_selector(inpt)[0]
-        element_tag = tokenized.name
+        tokens = cls._tokenize_selector(inpt)
+        if not tokens:
+            raise CSSParserError("Empty selector '{}'.".format(inpt))
+        return cls._from_token(tokens[0])
+
+    @classmethod
+    def _from_token(cls, token):
+        element_tag = token.name
         # if not element_tag:
         #     element_tag = "*"
-        if tokenized.type == '.':
+        if token.type == '.':
             element_type = cls.CLASS
-        elif tokenized.type == '#':
+        elif token.type == '#':
             element_type = cls.ID
         else:
             element_type = cls.ELEMENT
-            element_tag = element_tag
 
-        if tokenized.attribute:
-            attribute_filter = AttributeFilter.parse(tokenized.attribute)
+        if token.attribute:
+            attribute_filter = AttributeFilter.parse(token.attribute)
         else:
             attribute_filter = None
 
-        if tokenized.pseudo_class:
-            pseudo_class = Pseudo.parse(tokenized.pseudo_class)
+        if token.pseudo_class:
+            pseudo_class = Pseudo.parse(token.pseudo_class)
         else:
             pseudo_class = None
-        if tokenized.pseudo_element:
-            pseudo_element = Pseudo.parse(tokenized.pseudo_element)
+        if token.pseudo_element:
+            pseudo_element = Pseudo.parse(token.pseudo_element)
         else:
             pseudo_element = None
         return Element(element_tag, element_type, attribute_filter,
@@ -439,12 +476,12 @@ class Element(StaticAbstract):
                                 and (not self.element_tag 
                                 or element.get_attribute("id") == self.element_tag))
         elif self.element_type == Element.ELEMENT:
-            element_matches = (element.name.lower()==self.element_tag.lower()
+            element_matches = (element.tag_name is self._tag_name
                                 or self.element_tag=="*" 
-                                or not self.element_tag)
+                                or not self.element_tag
+                                or element.tag_name==self._tag_name)
         elif self.element_type == Element.CLASS:
-            element_matches =  (element.has_attribute("class") 
-                                and (self.element_tag in element.get_attribute("class").split(" "))
+            element_matches =  (self.element_tag in element.get_classes()
                                 or not self.element_tag)
             
         attribute_matches = True
@@ -490,6 +527,9 @@ class Selector(StaticAbstract):
     HAS_NEXT_SIBLING = 4
     HAS_FOLLOWING_SIBLINGS = 8
 
+    CONN_TYPES = {" ":HAS_CHILD, ">":HAS_DIRECT_CHILD, "+":HAS_NEXT_SIBLING,
+                  "~":HAS_FOLLOWING_SIBLINGS}
+
     def __init__(self, tail, conn_type=None, head=None):
         # head and tail are both CSSElements or CSSSelectors
         self.head = head
@@ -576,37 +616,45 @@ class Selector(StaticAbstract):
             else:
                 return None
 
+    def get_subject_elements(self):
+        """ returns the simple selectors that a matching element has to match
+        itself, ie. the ones in the last compound selector
+
+        for instance, for 'ul > li.item' this returns the '.item' and 'li' 
+        elements """
+        elements = [self.tail]
+        selector = self
+        while selector.conn_type == Selector.HAS_ALSO:
+            if isinstance(selector.head, Selector):
+                selector = selector.head
+                elements.append(selector.tail)
+            else:
+                elements.append(selector.head)
+                break
+        return elements
+
     @classmethod
     def parse(cls, inpt):
+        """ returns the Selector for 'inpt'. Selectors are cached (see 
+        SELECTORS) and shared, so the one returned must not be changed; use
+        'get_copy' for one that can be """
+        return SELECTORS.get(inpt)
+
+    @classmethod
+    def _parse(cls, inpt):
         inpt = inpt.strip()
         tokens = cls._tokenize_selector(inpt)
-        element = tokens[-1]
-        tail = Element.parse(''.join([element.type, element.name,
-                                      element.attribute, element.pseudo_class, 
-                                      element.pseudo_element]))
-        if len(tokens)>1:
-            parent = tokens[-2]
-            if parent.conn_type:
-                if parent.conn_type==" ":
-                    conn_type = Selector.HAS_CHILD
-                elif parent.conn_type==">":
-                    conn_type = Selector.HAS_DIRECT_CHILD
-                elif parent.conn_type=="+":
-                    conn_type = Selector.HAS_NEXT_SIBLING
-                elif parent.conn_type=="~":
-                    conn_type = Selector.HAS_FOLLOWING_SIBLINGS
-            elif len(tokens)>1:
-                conn_type = Selector.HAS_ALSO
-            selector_string = ''.join([t.joined() for t in tokens[:-1]])
-            if len(tokens)<=2:
-                head = Element.parse(selector_string)
-            else:
-                head = Selector.parse(selector_string)
-        else:
-            head = None
-            conn_type = None
-        return Selector(tail,conn_type,head)
-
+        if not tokens:
+            raise CSSParserError("Empty selector '{}'.".format(inpt))
+        # the chain is built from the left, each compound selector becoming
+        # the tail of a new Selector whose head is everything before it
+        selector = Element._from_token(tokens[0])
+        if len(tokens)==1:
+            return Selector(selector)
+        for parent, token in zip(tokens, tokens[1:]):
+            conn_type = Selector.CONN_TYPES.get(parent.conn_type, Selector.HAS_ALSO)
+            selector = Selector(Element._from_token(token), conn_type, selector)
+        return selector
 
     def match(self, element):
         if self.conn_type==None or self.head==None:
@@ -628,12 +676,13 @@ class Selector(StaticAbstract):
                 head_match_value = self.head.match(element.get_parent())
 
             elif self.conn_type == Selector.HAS_NEXT_SIBLING:
-                if not element.get_pre_siblings():
+                sibling = element.get_pre_sibling()
+                if sibling is None:
                     return False
-                head_match_value = self.head.match(element.get_pre_siblings()[-1])
+                head_match_value = self.head.match(sibling)
 
             elif self.conn_type == Selector.HAS_FOLLOWING_SIBLINGS:
-                for e in element.get_pre_siblings():
+                for e in reversed(element.get_pre_siblings()):
                     if self.head.match(e):
                         head_match_value = True
                         break
@@ -663,6 +712,58 @@ class Selector(StaticAbstract):
                 return self.head.render(flags)+"~"+self.tail.render(flags)
 
 
+class SelectorCache(object):
+    """ parsed Selectors, keyed by their selector text with its whitespace
+    collapsed. When the cache is full the least recently used one is dropped
+
+    'hits' and 'misses' count the lookups that were and were not found. The
+    cache can be used from several threads at once """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._selectors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "SelectorCache({}/{} selectors, {} hits, {} misses)".format(
+            len(self._selectors), self.size, self.hits, self.misses)
+
+    def __len__(self):
+        return len(self._selectors)
+
+    def get(self, inpt):
+        key = " ".join(inpt.split())
+        with self._lock:
+            selector = self._selectors.pop(key, None)
+            if selector is not None:
+                self.hits += 1
+                self._selectors[key] = selector
+                return selector
+            self.misses += 1
+        # selectors are parsed outside of the lock, so a slow one does not
+        # hold up other threads. Two threads may both parse the same one, in
+        # which case the last to finish is kept
+        selector = Selector._parse(key)
+        with self._lock:
+            self._selectors.pop(key, None)
+            if len(self._selectors)>=self.size:
+                self._selectors.popitem(last=False)
+            self._selectors[key] = selector
+        return selector
+
+    def clear(self):
+        with self._lock:
+            self._selectors.clear()
+            self.hits = self.misses = 0
+
+
+# every selector parsed by Selector.parse (and so Style.parse, Element.filter
+# and the Parser's html rules) goes through this cache
+SELECTOR_CACHE_SIZE = 1024
+SELECTORS = SelectorCache(SELECTOR_CACHE_SIZE)
+
+
 class Style(CSSAbstract, StaticAbstract):
     instance_count = 0
     UNIVERSAL_EMPTY_STYLE = "* {}"
@@ -708,7 +809,9 @@ class Style(CSSAbstract, StaticAbstract):
     @inherited.setter
     def inherited(self, val):
         for p in self.properties:
-            if not p.name in INHERITED_ATTRIBUTES:
+            # only an inherited style loses the properties that are not
+            # passed down to children
+            if val and not p.name in INHERITED_ATTRIBUTES:
                 self.properties.remove(p)
             else:
                 p.inherited = val
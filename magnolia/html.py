@@ -1,10 +1,15 @@
 import re
-import string
+import os
+import mmap
+import cPickle as pickle
+from bisect import bisect_left
 
 from configs import config
 from css import StyleSheet
 from css import Style
 from css import Selector
+from css import intern_symbol
+from css._abstract import reserve_instance_numbers
 
 # General locals
 # ~~~~~~~~~~~~~~~~~~~~~ #
@@ -13,12 +18,34 @@ INLINE_STYLE_SELECTOR = "__inline_style"
 
 MASTER_ELEMENT_NAME = "__head__"
 
+# about how much html 'iter_render' yields at once
+RENDER_BUFFER_SIZE = 64*1024
+
+# bumped whenever the output of Element.serialize changes
+SERIAL_VERSION = 1
+
 # src: https://developer.mozilla.org/en-US/docs/Glossary/Empty_element
 VOID_ELEMENTS = ["area","base","br","col",
                  "embed","hr","img","input",
                  "keygen","link","meta","param",
                  "source","track","wbr"]
 
+# src: https://developer.mozilla.org/en-US/docs/Web/HTML/Block-level_elements
+# along with the document, metadata and table elements. Whitespace next to
+# anything else, including unknown and custom elements, may show up
+BLOCK_ELEMENTS = ["address","article","aside","base","blockquote","body",
+                  "caption","center","col","colgroup","dd","details","dialog",
+                  "dir","div","dl","dt","fieldset","figcaption","figure",
+                  "footer","form","frame","frameset","h1","h2","h3","h4",
+                  "h5","h6","head","header","hgroup","hr","html","li","link",
+                  "main","menu","meta","nav","noframes","ol","p","pre",
+                  "section","style","table","tbody","td","tfoot","th",
+                  "thead","title","tr","ul",MASTER_ELEMENT_NAME]
+
+# minified rendering leaves the whitespace inside these as it is
+PRESERVE_WHITESPACE_ELEMENTS = ["pre","textarea","script","style","xmp","listing",
+                                "plaintext"]
+
 # src: https://developer.mozilla.org/en-US/docs/Web/SVG/Element
 SVG_ELEMENTS = ["a","altGlyph","altGlyphDef","altGlyphItem","animate",
                 "animateColor","animateMotion","animateTransform","audio",
@@ -53,127 +80,885 @@ MATHML_ELEMENTS = ["math","maction","maligngroup","malignmark","menclose",
 class HTMLParserError(Exception):
     pass
 
+class HTMLToken(object):
+    """ a single start or end tag found by the HTMLTokenizer
+
+    'start' and 'end' are offsets into the tokenized input, so the text between
+    two tags can be recovered without the tokenizer copying it """
+    def __init__(self, name, attributes, start, end, end_tag=False, self_closing=False):
+        self.name = name
+        self.attributes = attributes
+        self.start = start
+        self.end = end
+        self.end_tag = end_tag
+        self.self_closing = self_closing
+
+    def __repr__(self):
+        return "HTMLToken('{}{}',{},{})".format("/" if self.end_tag else "", self.name,
+                                                self.start, self.end)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class SourceIndex(object):
+    """ maps offsets in a parsed document to line and column numbers
+
+    The table of newline offsets is only built the first time a position is
+    asked for, after which each lookup is a binary search """
+    def __init__(self, text):
+        self.text = text
+        self._newlines = None
+
+    def _get_newlines(self):
+        if self._newlines is None:
+            newlines = []
+            i = self.text.find("\n")
+            while i>=0:
+                newlines.append(i)
+                i = self.text.find("\n", i+1)
+            self._newlines = newlines
+        return self._newlines
+
+    def get_position(self, offset):
+        """ returns the (line, column) of 'offset', both starting at 1 """
+        newlines = self._get_newlines()
+        line = bisect_left(newlines, offset)
+        if line:
+            return line+1, offset-newlines[line-1]
+        else:
+            return 1, offset+1
+
+
+class HTMLEvent(object):
+    """ a single event yielded by Element.iterparse """
+    START = "start"
+    END = "end"
+    TEXT = "text"
+
+    def __init__(self, event_type, name=None, attributes=None, text=None, 
+                       self_closing=False, start=None, end=None, buffer=None):
+        self.type = event_type
+        self.name = name
+        self.attributes = attributes or {}
+        self._text = text
+        self.self_closing = self_closing
+        # offsets of the event in the source
+        self.start = start
+        self.end = end
+        # text events from the parser keep the source buffer instead of a
+        # copy of their text, which is only sliced out if it is asked for
+        self.buffer = buffer
+
+    @property
+    def text(self):
+        if self._text is None and self.buffer is not None:
+            return self.buffer[self.start:self.end]
+        return self._text
+
+    def __repr__(self):
+        if self.type==HTMLEvent.TEXT:
+            return "HTMLEvent('{}',{} chars)".format(self.type, len(self.text))
+        return "HTMLEvent('{}','{}')".format(self.type, self.name)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class HTMLTokenizer(object):
+    """ a single pass, non-backtracking tag scanner
+
+    This accepts the same tags that Element.HTML_TOKENIZER used to, but scans
+    each '<' at most once. Anything that does not form a tag is left for the
+    caller to treat as text.
+    """
+    # runs of these are matched with anchored patterns so that every character
+    # is only looked at once, without the regex ever having to backtrack
+    TAG_OPEN = re.compile(r"<\s*(?P<end_tag>/)?\s*(?P<name>[^\s\0\"'></=]+)\s*")
+    ATTRIBUTE = re.compile(r"[^\s\0\"'></=]+\s*(?:(?P<equals>=)\s*"
+                           r"(?P<unquoted>[^\s\0\"'></=]+)?)?(?P<whitespace>\s*)")
+    WHITESPACE = re.compile(r"\s*")
+
+    def __init__(self, inpt):
+        self.inpt = inpt
+        # the position past which a given quote character no longer appears,
+        # this keeps unterminated strings from making the scan quadratic
+        self._missing_quotes = {}
+        # the offsets of each '<' that did not start a tag
+        self.text_brackets = []
+
+    def __iter__(self):
+        return self.tokenize()
+
+    def _find_quote(self, quote, start):
+        if start >= self._missing_quotes.get(quote, len(self.inpt)+1):
+            return -1
+        end = self.inpt.find(quote, start)
+        if end < 0:
+            self._missing_quotes[quote] = start
+        return end
+
+    def _scan_tag(self, i):
+        """ attempts to read a tag starting at the '<' at index i
+
+        returns an HTMLToken, or None if there is no tag at i """
+        inpt = self.inpt
+        tag = self.TAG_OPEN.match(inpt, i)
+        if not tag:
+            return None
+        j = attribute_start = tag.end()
+        after_unquoted = False
+        attribute = self.ATTRIBUTE.match(inpt, j)
+        while attribute:
+            j = attribute.end()
+            after_unquoted = False
+            if attribute.group("unquoted"):
+                after_unquoted = not attribute.group("whitespace")
+            elif attribute.group("equals"):
+                quote = inpt[j:j+1]
+                if not quote or not quote in "'\"":
+                    return None
+                j = self._find_quote(quote, j+1)
+                if j < 0:
+                    return None
+                j = self.WHITESPACE.match(inpt, j+1).end()
+            attribute = self.ATTRIBUTE.match(inpt, j)
+        c = inpt[j:j+1]
+        if c == ">":
+            return HTMLToken(intern_symbol(tag.group("name")), inpt[attribute_start:j], i, j+1,
+                             bool(tag.group("end_tag")))
+        elif c == "/":
+            # a '/' straight after an unquoted value is ambiguous, as it
+            # could be part of the value. Browsers read it as such, which
+            # is almost never what was intended
+            if after_unquoted:
+                raise HTMLParserError("Invalid self-closing tag '{}', "
+                                      "expected whitespace before '/'".format(tag.group("name")))
+            k = self.WHITESPACE.match(inpt, j+1).end()
+            if inpt[k:k+1]!=">":
+                return None
+            return HTMLToken(intern_symbol(tag.group("name")), inpt[attribute_start:j], i, k+1,
+                             bool(tag.group("end_tag")), True)
+        elif c and c in "'\"":
+            raise HTMLParserError("Unexpected string encountered in element attribute")
+        return None
+
+    def tokenize(self, start=0):
+        inpt = self.inpt
+        i = inpt.find("<", start)
+        while i >= 0:
+            token = self._scan_tag(i)
+            if token:
+                yield token
+                i = inpt.find("<", token.end)
+            else:
+                self.text_brackets.append(i)
+                i = inpt.find("<", i+1)
+
+
+class DocumentIndex(object):
+    """ the elements of a document by id, class and tag name
+
+    This is made by Element.get_document_index the first time the document 
+    is queried, and is then kept up to date as elements are added, removed, 
+    renamed or have their id or class changed, so selectors that name one of
+    these only have to look at the elements that have it """
+    # below this many elements per candidate, the candidates are sorted into
+    # document order rather than picked out of a walk of the tree
+    SORT_RATIO = 8
+
+    def __init__(self, root):
+        self.root = root
+        self.ids = {}
+        self.classes = {}
+        self.tags = {}
+        self.size = 0
+        self.add_tree(root)
+
+    @staticmethod
+    def _add_key(table, key, element):
+        elements = table.get(key)
+        if elements is None:
+            table[key] = elements = set()
+        elements.add(element)
+
+    @staticmethod
+    def _remove_key(table, key, element):
+        elements = table.get(key)
+        if elements is not None:
+            elements.discard(element)
+            if not elements:
+                del table[key]
+
+    def add(self, element):
+        element._document_index = self
+        self.size += 1
+        self._add_key(self.tags, element.tag_name, element)
+        element_id = element.get_attribute("id")
+        if element_id is not None:
+            self._add_key(self.ids, element_id, element)
+        for class_name in element.get_classes():
+            self._add_key(self.classes, class_name, element)
+
+    def remove(self, element):
+        element._document_index = None
+        self.size -= 1
+        self._remove_key(self.tags, element.tag_name, element)
+        element_id = element.get_attribute("id")
+        if element_id is not None:
+            self._remove_key(self.ids, element_id, element)
+        for class_name in element.get_classes():
+            self._remove_key(self.classes, class_name, element)
+
+    def add_tree(self, element):
+        for child in element.walk():
+            self.add(child)
+
+    def remove_tree(self, element):
+        for child in element.walk():
+            if child._document_index is self:
+                self.remove(child)
+
+    def get_candidates(self, selector):
+        """ returns the smallest set of elements that could match 'selector',
+        or None if it names no id, class or tag to look up """
+        candidates = None
+        for element in selector.get_subject_elements():
+            if not element.element_tag:
+                continue
+            if element.element_type==element.ID:
+                found = self.ids.get(element.element_tag)
+            elif element.element_type==element.CLASS:
+                found = self.classes.get(element.element_tag)
+            elif element.element_tag!="*":
+                found = self.tags.get(element.element_tag.lower())
+            else:
+                continue
+            if not found:
+                return frozenset()
+            if candidates is None or len(found)<len(candidates):
+                candidates = found
+        return candidates
+
+
+class MutationBatch(object):
+    """ removals from a document that are put off until the batch is applied
+
+    While the batch is open (it is used as a context manager), remove_child
+    only marks the child as detached, which Element.is_detached can check in
+    constant time. The marked children stay where they are until the batch
+    closes, and are then all unlinked in one pass. This lets a walk over the
+    tree carry on past elements that have been removed from it.
+
+    Until then, a detached child is still a child of its parent, so it is 
+    still found by get_elements, has_child, get_empty, the sibling methods
+    and queries. Code that runs inside a batch should check is_detached """
+    # the open batches, by the id of the root element of their document
+    _open = {}
+
+    def __init__(self, root):
+        self.root = root
+        self._removed = []
+
+    @classmethod
+    def get_open(cls, element):
+        """ returns the batch open on the document 'element' is in, or None """
+        if not cls._open:
+            return None
+        return cls._open.get(id(element._get_root()))
+
+    def __enter__(self):
+        if id(self.root) in MutationBatch._open:
+            raise ValueError("The document already has an open batch")
+        MutationBatch._open[id(self.root)] = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        del MutationBatch._open[id(self.root)]
+        self.apply()
+
+    def remove(self, element):
+        if not element._detached:
+            element._detached = True
+            self._removed.append(element)
+
+    def apply(self):
+        """ unlinks every element removed since the batch was last applied """
+        removed, self._removed = self._removed, []
+        for element in removed:
+            # a detached element that has since been moved is left where it is
+            if element._detached:
+                element._detached = False
+                parent = element.parent
+                if parent is not None and parent._is_child(element):
+                    # the positions of the parent's elements are built again
+                    # when they are next needed, rather than after every removal
+                    parent._reset_elements()
+                    parent._unlink_child(element)
+
+
 class Element(object):
-    # I am sorry bobince
-    # https://stackoverflow.com/questions/1732348/regex-match-open-elements-except-xhtml-self-contained-elements#answer-1732454
-    #
-    # on a serious note, this needs to be removed in favour of a traditional 
-    # parser
-    HTML_TOKENIZER = re.compile(r"<\s*(?P<end_tag>/)?"
-                        r"\s*(?P<name>[^\s\0\"'></=]+)\s*"
-                        r"(?P<attributes>(?:[^\s\0\"'></=]+"
-                        r"(?:\s*=\s*(?:(?P<oq>['\"])[^\4]*?(?P=oq)|(?P<unquot>[^\s\0\"'></=]+)))?\s*?)*)"
-                        r"(?P<self_closing>(?:(?(unquot)\s)\s*?/)?)\s*>",re.DOTALL)
     INLINE_STYLES = 1
 
+    # orders for 'walk'
+    PRE_ORDER = "pre"
+    POST_ORDER = "post"
+
+    # what an element shares with its forks, and copies before changing
+    SHARED_ATTRIBUTES = 1
+    SHARED_STYLES = 2
+
+    # files at least this large are memory mapped by 'parse', smaller ones
+    # are read into a string
+    MMAP_MIN_SIZE = 512*1024
+
+    # a parsed page has one of these for every tag and run of text, so they
+    # do not get a __dict__
+    __slots__ = ("_name", "tag_name", "parent", "_styles", "_attributes", "_class_source",
+                 "_classes", "_inline_style", "_self_closing", "_source",
+                 "_source_start", "_source_end", "_content_start", "_content_end",
+                 "_text_brackets", "_elements", "_element_positions", "_elements_by_name",
+                 "_prev", "_next", "_first_child", "_last_child", "_child_list",
+                 "_document_index", "_detached", "_shared")
+
+    # put on the render stack by 'iter_render' under the children of an
+    # element that keeps its whitespace
+    _PRESERVE_MARKER = object()
+
+    # attribute values that can be rendered without quotes
+    UNQUOTED_VALUE = re.compile(r"[^\s\"'=<>`/]+\Z")
+
+    ATTRIBUTE_TOKENIZER = re.compile(r"(?P<whitespace>\s+)|(?P<word>[^\s\"'=<>`\0]+)|(?P<equals>=)"
+                                     r"|(?P<string>\"[^\"]*\"?|'[^']*'?)|(?P<invalid>.)",re.DOTALL)
+
     def __init__(self, element_name, parent=None, **attributes):
+        self.parent = None
+        # the DocumentIndex of the document, once it has been queried
+        self._document_index = None
+        # set while the element is removed in a MutationBatch
+        self._detached = False
         self.name = element_name
         self.parent = parent
-        self.styles = StyleSheet()
+        # the stylesheet and inline style are only made when first used, as
+        # most elements (and every text element) never need them
+        self._styles = None
 
-        self._attributes = {str(k):str(v) for k,v in attributes.items()}
-        self._inline_style = Style.parse(Style.UNIVERSAL_EMPTY_STYLE)
-        self._children = []
+        # attribute names come from a small set, so they are interned rather
+        # than every element keeping its own copies
+        self._attributes = {intern_symbol(str(k)):str(v) for k,v in attributes.items()}
+        self._class_source = None
+        self._classes = frozenset()
+        self._inline_style = None
         self._self_closing = False
+        self._shared = 0
+        # the children are a doubly linked list, so they can be inserted and
+        # removed anywhere in constant time. '_children' is a list view of 
+        # them, which is made when first needed and kept until they change
+        # somewhere other than the end
+        self._prev = None
+        self._next = None
+        self._first_child = None
+        self._last_child = None
+        self._child_list = None
+        # the element children, their positions and the element children by
+        # name. These are built when first needed, and dropped whenever the
+        # children change in a way that can not be cheaply updated
+        self._elements = None
+        self._element_positions = None
+        self._elements_by_name = None
 
-        self._inline_style.inline =True
+        # where the element came from, if it was parsed
+        self._source = None
+        self._source_start = None
+        self._source_end = None
+        # the offsets between the start and end tags
+        self._content_start = None
+        self._content_end = None
+        # on the head of a parsed tree, the offsets of the '<'s that were
+        # read as text. See 'reparse'
+        self._text_brackets = None
 
     def __repr__(self):
         return "HTMLElement('{}',{} children)".format(self.name, len(self._children))
 
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        index = self._document_index
+        if index is not None:
+            index.remove(self)
+        self._name = intern_symbol(value)
+        # 'tag_name' is the lowercased name. As it is interned, selectors can
+        # compare it by identity instead of lowercasing on every match
+        self.tag_name = intern_symbol(value.lower())
+        if index is not None:
+            index.add(self)
+        # the parent keeps its elements by name
+        if self.parent is not None:
+            self.parent._reset_elements()
+
     def __str__(self):
         return self.__repr__()
 
-    def __getattribute__(self, attr):
-        try:
-            return object.__getattribute__(self,attr)
-        except AttributeError:
-            if config.REFERENCE_ELEMENTS_AS_ATTRIBUTES:
-                found = []
-                for child in object.__getattribute__(self,"_children"):
-                    if child.name==attr:
-                        found.append(child)
-                if found:
-                    return found
-                else:
-                    raise
+    def __getattr__(self, attr):
+        # this is only reached when normal lookup fails. Private names are
+        # never children, and may not have been set yet
+        if config.REFERENCE_ELEMENTS_AS_ATTRIBUTES and not attr.startswith("_"):
+            found = []
+            for child in self._children:
+                if child.name==attr:
+                    found.append(child)
+            if found:
+                return found
+        raise AttributeError("'{}' object has no attribute '{}'".format(
+            type(self).__name__, attr))
+
+    def walk(self, order=PRE_ORDER, name=None, prune=None):
+        """ yields this element and every element below it
+
+        'order' is Element.PRE_ORDER (parents before their children) or 
+        Element.POST_ORDER (children before their parents). If 'name' is 
+        given, only elements with that name are yielded. If 'prune' is given,
+        it is called with each element and the children of any element it 
+        returns True for are skipped.
+
+        The tree is walked with an explicit stack, so any depth of tree can 
+        be walked. In pre-order, the children of an element are only looked
+        at after it has been yielded, so they may be changed by the caller """
+        if order==Element.PRE_ORDER:
+            return self._walk_pre_order(name, prune)
+        elif order==Element.POST_ORDER:
+            return self._walk_post_order(name, prune)
+        raise ValueError("Unknown order '{}'".format(order))
+
+    def _walk_pre_order(self, name, prune):
+        stack = [self]
+        pop, extend = stack.pop, stack.extend
+        while stack:
+            element = pop()
+            if not name or element._name==name:
+                yield element
+            if not (prune and prune(element)):
+                extend(reversed(element._get_element_list()))
+
+    def _walk_post_order(self, name, prune):
+        # each element is on the stack twice, once to add its children and
+        # then again to be yielded after them
+        stack = [(self, False)]
+        while stack:
+            element, visited = stack.pop()
+            if visited or (prune and prune(element)):
+                if not name or element._name==name:
+                    yield element
             else:
-                raise
+                stack.append((element, True))
+                stack.extend((child, False) for child in 
+                             reversed(element._get_element_list()))
+
+    def iter(self, name=None):
+        """ yields this element and every element below it (with 'name', if
+        given) in document order """
+        return self.walk(Element.PRE_ORDER, name)
 
     def map(self, func):
-        func(self)
-        for child in self.get_elements():
-            child.map(func)
+        for element in self.walk():
+            func(element)
 
     def filter(self, func):
+        if isinstance(func, (str, Selector)):
+            return list(self.query_iter(func))
+        return [element for element in self.walk() if func(element)]
+
+    @staticmethod
+    def _get_selector(selector):
+        if isinstance(selector, Selector):
+            return selector
+        return Selector.parse(selector)
+
+    def query_iter(self, selector):
+        """ yields this element and the elements below it that match 
+        'selector' (a Selector or selector string) in document order
+
+        Each element is only matched when the next one is asked for, so a 
+        caller that stops early does not pay for the rest of the tree """
+        selector = self._get_selector(selector)
+        # the document index gives the elements that could match. A few of
+        # them are sorted into document order, but a lot of them are quicker
+        # to pick out of a walk
+        index = self.get_document_index()
+        candidates = index.get_candidates(selector)
+        if candidates is None:
+            elements = self.walk()
+        elif len(candidates)*DocumentIndex.SORT_RATIO>=index.size:
+            elements = (element for element in self.walk() if element in candidates)
+        else:
+            elements = self._sort_elements(candidates)
+        for element in elements:
+            if selector.match(element):
+                yield element
+
+    def query_one(self, selector):
+        """ returns the first element (in document order) at or below this one
+        that matches 'selector', or None if there is no match """
+        for element in self.query_iter(selector):
+            return element
+        return None
+
+    def _sort_elements(self, elements):
+        # the elements that are at or below this one, in document order
         found = []
-        if isinstance(func, str):
-            func = Selector.parse(func)
-        if isinstance(func,Selector):
-            if func.match(self):
-                found.append(self)
+        for element in elements:
+            path = element._get_path(self)
+            if path is not None:
+                found.append((path, element))
+        found.sort(key=lambda item: item[0])
+        return [element for path, element in found]
+
+    def _get_path(self, top):
+        # the indexes of the element and its parents below 'top', or None if
+        # it is not below 'top'
+        path = []
+        element = self
+        while element is not top:
+            if element.parent is None:
+                return None
+            path.append(element.get_index())
+            element = element.parent
+        path.reverse()
+        return path
+
+    def fork(self):
+        """ returns a copy of the element and everything below it, which 
+        shares their attributes, styles and text until either tree changes 
+        them
+
+        As elements link to their parents and siblings, the fork has its own
+        element objects, but these are only shells. Attribute dicts and 
+        stylesheets are copied by whichever tree changes them first, and text
+        is never copied, so forking a styled tree costs far less than parsing
+        and styling it again
+
+        Use get_styles rather than 'styles' to only read the styles of
+        either tree, as 'styles' copies them so they can be changed in
+        place """
+        new_root = self._fork_element()
+        stack = [(self, new_root)]
+        while stack:
+            element, new_element = stack.pop()
+            child = element._first_child
+            while child is not None:
+                new_child = child._fork_element()
+                new_element._link_child(new_child)
+                if not isinstance(child, TextElement):
+                    stack.append((child, new_child))
+                child = child._next
+        return new_root
+
+    def _fork_element(self):
+        # a new unlinked element sharing everything but the links. Both this
+        # element and the new one copy what they share before changing it
+        new_element = object.__new__(type(self))
+        self._shared = new_element._shared = Element.SHARED_ATTRIBUTES|Element.SHARED_STYLES
+        new_element._name = self._name
+        new_element.tag_name = self.tag_name
+        new_element.parent = None
+        new_element._styles = self._styles
+        new_element._attributes = self._attributes
+        new_element._class_source = self._class_source
+        new_element._classes = self._classes
+        new_element._inline_style = self._inline_style
+        new_element._self_closing = self._self_closing
+        new_element._source = self._source
+        new_element._source_start = self._source_start
+        new_element._source_end = self._source_end
+        new_element._content_start = self._content_start
+        new_element._content_end = self._content_end
+        new_element._text_brackets = self._text_brackets
+        new_element._elements = None
+        new_element._element_positions = None
+        new_element._elements_by_name = None
+        new_element._prev = None
+        new_element._next = None
+        new_element._first_child = None
+        new_element._last_child = None
+        new_element._child_list = None
+        new_element._document_index = None
+        new_element._detached = False
+        return new_element
+
+    def get_document_index(self):
+        """ returns the DocumentIndex of the document the element is in, 
+        making it if it has not been queried before """
+        if self._document_index is None:
+            DocumentIndex(self._get_root())
+        return self._document_index
+
+    def _get_root(self):
+        root = self
+        while root.parent is not None and root.parent._is_child(root):
+            root = root.parent
+        return root
+
+    @property
+    def _children(self):
+        if self._child_list is None:
+            children = []
+            child = self._first_child
+            while child is not None:
+                children.append(child)
+                child = child._next
+            self._child_list = children
+        return self._child_list
+
+    def _is_child(self, child):
+        return child.parent is self and (child._prev is not None or self._first_child is child)
+
+    def _link_child(self, child, before=None):
+        # puts 'child' in front of the child 'before', or at the end
+        if child is before:
+            return
+        if child.parent is not None and child.parent._is_child(child):
+            child.parent._unlink_child(child)
+        child.parent = self
+        child._detached = False
+        # the child joins the index of its new document, if it has one
+        if not isinstance(child, TextElement):
+            if child._document_index is not None:
+                child._document_index.remove_tree(child)
+            if self._document_index is not None:
+                self._document_index.add_tree(child)
+        if before is None:
+            child._prev = self._last_child
+            child._next = None
+            if self._last_child is None:
+                self._first_child = child
+            else:
+                self._last_child._next = child
+            self._last_child = child
+            if self._child_list is not None:
+                self._child_list.append(child)
+            if self._elements is not None and not isinstance(child, TextElement):
+                self._append_element(child)
         else:
-            if func(self): 
-                found.append(self)
-        for child in self.get_elements():
-            found.extend(child.filter(func))
-        return found
+            child._prev = before._prev
+            child._next = before
+            if before._prev is None:
+                self._first_child = child
+            else:
+                before._prev._next = child
+            before._prev = child
+            self._child_list = None
+            if self._elements is not None and not isinstance(child, TextElement):
+                self._insert_element(child)
 
-    def insert_child(self, child, index=-1, **attributes):
+    def _unlink_child(self, child):
+        if child._prev is None:
+            self._first_child = child._next
+        else:
+            child._prev._next = child._next
+        if child._next is None:
+            self._last_child = child._prev
+        else:
+            child._next._prev = child._prev
+        child._prev = None
+        child._next = None
+        # the old list is left to anything still looping over it
+        self._child_list = None
+        if not isinstance(child, TextElement):
+            if self._elements is not None:
+                self._remove_element(child)
+            if child._document_index is not None:
+                child._document_index.remove_tree(child)
+
+    @staticmethod
+    def _make_child(child, parent, **attributes):
         if isinstance(child,str):
-            new_child = Element(child, self, **attributes)
+            return Element(child, parent, **attributes)
         elif isinstance(child, Element):
-            new_child = child
-            new_child.parent = self
-        else:
+            return child
+        return None
+
+    def insert_child(self, child, index=-1, **attributes):
+        new_child = self._make_child(child, self, **attributes)
+        if new_child is None:
             return
-        if index<0:
-            self._children.append(new_child)
+        if index<0 or index>=len(self._children):
+            self._link_child(new_child)
         else:
-            self._children.insert(index,new_child)
+            self._link_child(new_child, self._children[index])
 
     def add_child(self,child, **attributes):
         self.insert_child(child,-1,**attributes)
 
+    def insert_before(self, child, reference, **attributes):
+        """ inserts 'child' (an element or element name) in front of the 
+        child 'reference' """
+        if not self._is_child(reference):
+            raise ValueError("{} is not a child of {}".format(reference, self))
+        new_child = self._make_child(child, self, **attributes)
+        if new_child is not None:
+            self._link_child(new_child, reference)
+
+    def insert_after(self, child, reference, **attributes):
+        """ inserts 'child' (an element or element name) after the child 
+        'reference' """
+        if not self._is_child(reference):
+            raise ValueError("{} is not a child of {}".format(reference, self))
+        new_child = self._make_child(child, self, **attributes)
+        if new_child is not None:
+            self._link_child(new_child, reference._next)
+
     def remove_child(self, child):
-        self._children.remove(child)
+        if not self._is_child(child):
+            raise ValueError("{} is not a child of {}".format(child, self))
+        batch = MutationBatch.get_open(self)
+        if batch is not None:
+            batch.remove(child)
+        else:
+            self._unlink_child(child)
+
+    def batch(self):
+        """ returns a MutationBatch for the document the element is in
+
+        with tree.batch():
+            for element in tree.walk(prune=Element.is_detached):
+                ...
+
+        Children removed inside the batch are only unlinked when it closes
+        (see MutationBatch) """
+        return MutationBatch(self._get_root())
+
+    def is_detached(self):
+        """ returns True if the element has been removed in an open batch """
+        return self._detached
+
+    def remove(self):
+        """ removes the element from its parent """
+        self.parent.remove_child(self)
 
     def clear_children(self):
-        self._children = []
+        child = self._first_child
+        while child is not None:
+            next_child = child._next
+            child._prev = None
+            child._next = None
+            if child._document_index is not None:
+                child._document_index.remove_tree(child)
+            child = next_child
+        self._first_child = None
+        self._last_child = None
+        self._child_list = []
+        self._reset_elements()
 
     def has_child(self, child=None):
         if not child:
-            return bool(self._children)
+            return self._first_child is not None
         else:
-            return child in self._children
+            return self._is_child(child)
 
-    def get_elements(self, name=None):
+    def _reset_elements(self):
+        self._elements = None
+        self._element_positions = None
+        self._elements_by_name = None
+
+    def _append_element(self, element):
+        of_type = self._elements_by_name.setdefault(element.name, [])
+        self._element_positions[id(element)] = (len(self._elements), len(of_type))
+        self._elements.append(element)
+        of_type.append(element)
+
+    def _insert_element(self, element):
+        # puts the newly linked 'element' into the cached lists. Only the 
+        # positions of the elements after it change
+        following = element.get_post_sibling()
+        if following is None:
+            self._append_element(element)
+            return
+        index = self._element_positions[id(following)][0]
+        of_type = self._elements_by_name.setdefault(element.name, [])
+        type_index = len(of_type)
+        for sibling in self._elements[index:]:
+            if sibling.name==element.name:
+                type_index = self._element_positions[id(sibling)][1]
+                break
+        self._elements.insert(index, element)
+        of_type.insert(type_index, element)
+        self._element_positions[id(element)] = (index, type_index)
+        self._renumber_elements(index+1, element.name, 1)
+
+    def _remove_element(self, element):
+        # takes 'element' out of the cached lists. Removing the last element 
+        # does not change any other positions
+        index, type_index = self._element_positions.pop(id(element))
+        del self._elements[index]
+        of_type = self._elements_by_name[element.name]
+        del of_type[type_index]
+        if not of_type:
+            del self._elements_by_name[element.name]
+        self._renumber_elements(index, element.name, -1)
+
+    def _renumber_elements(self, start, name, change):
+        # moves the elements from 'start' on to their new positions, after
+        # an element named 'name' was put in or taken out in front of them
+        positions = self._element_positions
+        for i in xrange(start, len(self._elements)):
+            sibling = self._elements[i]
+            type_index = positions[id(sibling)][1]
+            if sibling.name==name:
+                type_index += change
+            positions[id(sibling)] = (i, type_index)
+
+    def _get_element_list(self, name=None):
+        # the cached list itself, which must not be changed by the caller
+        if self._elements is None:
+            self._elements = []
+            self._element_positions = {}
+            self._elements_by_name = {}
+            for child in self._children:
+                if not isinstance(child, TextElement):
+                    self._append_element(child)
         if name:
-            return filter(lambda e: not isinstance(e, TextElement) and e.name==name, self._children)
-        else:
-            return filter(lambda e: not isinstance(e, TextElement),self._children)
+            return self._elements_by_name.get(name, [])
+        return self._elements
+
+    def get_elements(self, name=None):
+        return list(self._get_element_list(name))
+
+    def get_element_count(self, name=None):
+        return len(self._get_element_list(name))
+
+    def get_index(self, of_type=False):
+        """ returns the position of the element among the elements of its 
+        parent (or only the ones with its name if 'of_type' is set), or None
+        if it has no parent """
+        if not self.parent:
+            return None
+        self.parent._get_element_list()
+        position = self.parent._element_positions.get(id(self))
+        if position is None:
+            return None
+        return position[1] if of_type else position[0]
 
     def insert_element(self, element, index=-1, **attributes):
-        if isinstance(element, str):
-            new_child = Element(element,self,**attributes)
-        elif isinstance(element, Element):
-            new_child = element
-            new_child.parent = self
-        else:
+        new_child = self._make_child(element, self, **attributes)
+        if new_child is None:
             return
+        elements = self._get_element_list()
         if index<0:
-            if len(self._children):
-                target_index = self._children.index(self.get_elements()[-1])
-                self._children.insert(target_index+1, new_child) # a weird case where you add after
+            # a weird case where you add after the last element
+            if elements:
+                self._link_child(new_child, elements[-1]._next)
             else:
-                self._children.append(new_child)
+                self._link_child(new_child)
         else:
             # convert the element index to the child index
-            if self.get_elements():
-                target_index = self._children.index(self.get_elements()[index])
+            if elements:
+                self._link_child(new_child, elements[index])
             else:
-                target_index = 0
-            self._children.insert(target_index, new_child)    
+                self._link_child(new_child, self._first_child)
 
     def add_element(self, element, **attributes):
         self.insert_element(element,-1, **attributes)
@@ -190,56 +975,50 @@ class Element(object):
         return self._get_empty()   
    
     def get_pre_siblings(self):
-        if not self.parent:
+        index = self.get_index()
+        if index is None:
             return []
-        siblings = []
-        for sibling in self.parent._children[:self.parent._children.index(self)]:
-            if not sibling is self:
-                if not isinstance(sibling, TextElement):
-                    siblings.append(sibling)
-            else:
-                break
-        return siblings
+        return self.parent._get_element_list()[:index]
 
     def get_post_siblings(self):
-        if not self.parent:
+        index = self.get_index()
+        if index is None:
             return []
-        siblings = []
-        for sibling in self.parent._children[self.parent._children.index(self)+1:]:
-            if not sibling is self:
-                if not isinstance(sibling, TextElement):
-                    siblings.append(sibling)
-        return siblings
+        return self.parent._get_element_list()[index+1:]
+
+    def get_pre_sibling(self):
+        """ returns the element just before this one, or None """
+        sibling = self._prev
+        while isinstance(sibling, TextElement):
+            sibling = sibling._prev
+        return sibling
+
+    def get_post_sibling(self):
+        """ returns the element just after this one, or None """
+        sibling = self._next
+        while isinstance(sibling, TextElement):
+            sibling = sibling._next
+        return sibling
 
     def get_pre_text(self):
-        if not self.parent:
-            return []
         siblings = []
-        for sibling in self.parent._children[:self.parent._children.index(self)]:
-            if not sibling is self:
-                if isinstance(sibling, TextElement):
-                    siblings.append(sibling)
-                elif type(sibling) is Element:
-                    siblings = []
-            else:
-                break
-        return siblings
+        sibling = self._prev
+        while isinstance(sibling, TextElement):
+            siblings.append(sibling)
+            sibling = sibling._prev
+        return siblings[::-1]
 
     def get_post_text(self):
-        if not self.parent:
-            return []
         siblings = []
-        for sibling in self.parent._children[self.parent._children.index(self)+1:]:
-            if not sibling is self:
-                if isinstance(sibling, TextElement):
-                    siblings.append(sibling)
-                elif type(sibling) is Element:
-                    break
+        sibling = self._next
+        while isinstance(sibling, TextElement):
+            siblings.append(sibling)
+            sibling = sibling._next
         return siblings
 
     def add_text(self, text):
         if text:
-            self._children.append(TextElement(text, self))
+            self._link_child(TextElement(text, self))
 
     def get_encapsulating_text(self):
         return self.get_pre_text()+self.get_post_text()
@@ -248,8 +1027,10 @@ class Element(object):
         return self.get_pre_siblings()+self.get_post_siblings()
 
     def add_pre_sibling(self, element, **attributes):
-        if isinstance(element, Element):
-            self.parent.add_child
+        self.parent.insert_before(element, self, **attributes)
+
+    def add_post_sibling(self, element, **attributes):
+        self.parent.insert_after(element, self, **attributes)
 
     def has_parent(self):
         return bool(self.parent)
@@ -265,6 +1046,25 @@ class Element(object):
             curr_node = curr_node.parent
         return parents
 
+    def _set_source(self, source, start, end=None):
+        self._source = source
+        self._source_start = start
+        self._source_end = end
+
+    def get_source_span(self):
+        """ returns the (start, end) offsets of the element in the parsed 
+        source, or None if it was not parsed """
+        if self._source is None:
+            return None
+        return self._source_start, self._source_end
+
+    def get_source_position(self):
+        """ returns the (line, column) the element starts at in the parsed 
+        source, or None if it was not parsed """
+        if self._source is None:
+            return None
+        return self._source.get_position(self._source_start)
+
     def has_attribute(self, attribute):
         return attribute in self._attributes.keys()
 
@@ -275,42 +1075,120 @@ class Element(object):
             return None
 
     def set_attribute(self, attribute, value):
-        self._attributes[attribute] = str(value)
+        if self._shared&Element.SHARED_ATTRIBUTES:
+            self._attributes = dict(self._attributes)
+            self._shared &= ~Element.SHARED_ATTRIBUTES
+        attribute = intern_symbol(str(attribute))
+        index = self._document_index
+        if index is not None and attribute in ("id", "class"):
+            index.remove(self)
+            self._attributes[attribute] = str(value)
+            index.add(self)
+        else:
+            self._attributes[attribute] = str(value)
+
+    def get_classes(self):
+        """ returns the set of (interned) class names in the 'class' attribute """
+        class_source = self._attributes.get("class")
+        # only split the attribute again if it has been changed
+        if class_source is not self._class_source:
+            self._class_source = class_source
+            if class_source is None:
+                self._classes = frozenset()
+            else:
+                self._classes = frozenset(intern_symbol(c) for c in class_source.split(" "))
+        return self._classes
+
+    @property
+    def styles(self):
+        # the stylesheet may be changed in place through this, so one shared
+        # with a fork is copied first. get_styles does not copy it
+        return self._get_own_styles()
+
+    def get_styles(self):
+        """ returns the stylesheet of the element, which may be shared with a
+        fork, so it must only be read. Use 'styles' to change it """
+        if self._styles is None:
+            self._styles = StyleSheet()
+        return self._styles
+
+    def _get_own_styles(self):
+        # the stylesheet, copied first if it is shared with a fork
+        self._own_styles()
+        if self._styles is None:
+            self._styles = StyleSheet()
+        return self._styles
+
+    @styles.setter
+    def styles(self, value):
+        self._own_styles()
+        self._styles = value
+
+    def _own_styles(self):
+        if self._shared&Element.SHARED_STYLES:
+            if self._styles is not None:
+                self._styles = self._styles.get_copy()
+            if self._inline_style is not None:
+                self._inline_style = self._inline_style.get_copy()
+            self._shared &= ~Element.SHARED_STYLES
 
     def has_styles(self):
-        return bool(self.styles)
+        return bool(self._styles)
+
+    @staticmethod
+    def _get_style_offsets(stylesheets):
+        # stylesheets may be shared between documents (see
+        # cache.StyleSheetRegistry), so their instance numbers say nothing
+        # about the order a document links them in. Each one is given a new
+        # range of numbers, in the order they are passed, and the styles
+        # matched from it are moved into that range as they are copied in
+        offsets = []
+        for stylesheet in stylesheets:
+            instance_range = stylesheet.get_instance_range()
+            if instance_range is None:
+                offsets.append(0)
+                continue
+            first, last = instance_range
+            offsets.append(reserve_instance_numbers(last-first+1)-first)
+        return offsets
 
-    def _apply_styles(self, inherited_style=None, *stylesheets):
+    def _apply_styles(self, inherited_style, stylesheets, offsets):
         special_selector = "{}>{}>{{}} {{{{}}}}".format(
             ">".join([parent.name for parent in self.get_parents()[::-1]]),self.name)
 
+        styles = self._get_own_styles()
         if inherited_style:
-            self.styles.merge(inherited_style)
+            styles.merge(inherited_style)
         if stylesheets:
-            for stylesheet in stylesheets:
+            for stylesheet, offset in zip(stylesheets, offsets):
                 for style in stylesheet.match(self):
-                    self.styles.merge(style)
+                    styles.merge(style, offset)
         elif self.has_attribute("style"):
             self._inline_style = Style.from_properties(self.get_attribute("style"),
                 special_selector.format(INLINE_STYLE_SELECTOR))
             self._inline_style.inline = True
-            self.styles.merge(self._inline_style)
+            styles.merge(self._inline_style)
 
-        inherited_style = self.styles.flatten(Style.parse(
+        inherited_style = styles.flatten(Style.parse(
             special_selector.format(INHERITED_STYLE_SELECTOR)))
         inherited_style.inherited = True
         for child in self.get_elements():
-            child._apply_styles(inherited_style, *stylesheets)
+            child._apply_styles(inherited_style, stylesheets, offsets)
 
     def apply_styles(self, *stylesheets):
-        self._apply_styles(None, *stylesheets)   
+        self._apply_styles(None, stylesheets, self._get_style_offsets(stylesheets))   
 
     def reset_styles(self):
-        self.styles = StyleSheet()
+        self._own_styles()
+        self._styles = None
         for child in self._children:
             child.reset_styles()
 
     def add_inline_property(self, name, value):
+        self._own_styles()
+        if self._inline_style is None:
+            self._inline_style = Style.parse(Style.UNIVERSAL_EMPTY_STYLE)
+            self._inline_style.inline = True
         self._inline_style.add_property(name, value)
 
     @staticmethod
@@ -320,232 +1198,631 @@ class Element(object):
         else:
             # we're parsing this baby
             # parsing as per https://www.w3.org/TR/2011/WD-html5-20110525/syntax.html#syntax-attribute-name
+            #
+            # the string is split into runs of whitespace, names/unquoted 
+            # values, '=' and quoted values, so that the loop below only runs
+            # once per run rather than once per character
             attrs = {}
-            k=i=0
-            attr = val = ""
-            string_char=None
-            update_k = False
-            passed_whitespace = False
-            waiting_for_value = False
-            while i<len(attribute_string):
-                if (attribute_string[i] in "'\"" and (not string_char
-                  or attribute_string[i]==string_char)):
-                    if not attr:
-                        raise HTMLParserError("Unexpected string encountered in element attribute")
-                    elif string_char:
-                        val = attribute_string[k:i]
-                        if attr:
-                            attrs[attr]=val
-                            attr=val=""
-                        else:
-                            raise HTMLParserError("Attribute value encountered before name")
-                        string_char = None
-                    else:
-                        string_char = attribute_string[i]
-                    update_k = True
-
-                elif string_char:
-                    # if we are in a string
-                    #
-                    # note: there are very few rules for strings that I will 
-                    #       be enforcing at the moment, so ignore all 
-                    #       characters in string
+            attr = ""
+            word = None
+            for token in Element.ATTRIBUTE_TOKENIZER.finditer(attribute_string):
+                token_type = token.lastgroup
+                if token_type=="whitespace":
                     pass
 
-                elif attribute_string[i] in string.whitespace:
-                    # if we are in unquoted value and encounter whitespace
-                    passed_whitespace = True
+                elif token_type=="word":
+                    # a word after a word is either the value of the attribute
+                    # before '=', or an attribute without a value
+                    if word:
+                        if attr:
+                            attrs[attr] = word
+                            attr = ""
+                        else:
+                            # this needs to be changed to 'None' eventually
+                            attrs[intern_symbol(word)] = ""
+                    word = token.group()
 
-                elif attribute_string[i]=="=":
+                elif token_type=="equals":
                     if attr:
                         raise HTMLParserError("Unexpected '=' encountered,"
                                               " expected attribute value")
+                    attr = intern_symbol(word) if word else ""
+                    word = None
+
+                elif token_type=="string":
+                    if not attr:
+                        raise HTMLParserError("Unexpected string encountered in element attribute")
+                    value = token.group()
+                    if len(value)>1 and value.endswith(value[0]):
+                        attrs[attr] = value[1:-1]
+                        attr = ""
+                        word = None
                     else:
-                        attr = attribute_string[k:i].strip()
-                        update_k = True
-                        waiting_for_value = True
-                        passed_whitespace = False
-
-                # checking for some of these characters is redundant, but this
-                # is done for consistency with the W3C html5 specs (at least
-                # as much as possible)
-                elif not string_char and attribute_string[i] in "'\"=<>`\0":
+                        # an unterminated string runs to the end of the input
+                        word = value[1:].strip()
+
+                else:
+                    # checking for some of these characters is redundant, but
+                    # this is done for consistency with the W3C html5 specs
+                    # (at least as much as possible)
                     raise HTMLParserError("Invalid attribute character '{}' encountered".format(
-                        attribute_string[i]))
+                        token.group()))
+            if word:
+                if attr:
+                    attrs[attr] = word
                 else:
-                    # this should only be unquoted valid chars
-                    if passed_whitespace:
-                        if waiting_for_value and attribute_string[k:i].strip() and attr:
-                            attrs[attr] = attribute_string[k:i].strip()
-                            attr=val=""
-                            k=i
-                        elif attribute_string[k:i].strip():
-                            attr = attribute_string[k:i].strip()
-                            # this needs to be changed to 'None' eventually
-                            attrs[attr] = ""
-                            attr=val=""
-                            k=i
-                        passed_whitespace = False
-                i+=1
-                if update_k:
-                    k=i
-                    update_k = False
-            if k<len(attribute_string):
-                if attribute_string[k:i].strip():
-                    if attr:
-                        attrs[attr]=attribute_string[k:i].strip()
-                    else:
-                        attrs[attribute_string[k:i].strip()]=""
+                    attrs[intern_symbol(word)] = ""
             return attrs
 
     @staticmethod
-    def _raise_end_tag_error(inpt, element, error_string, *args, **kwargs):
-        err_msg = "Unexpected end element on line {{}}, col {{}}. {}".format(error_string.format( 
-                                                                         *args, **kwargs))
-        raise HTMLParserError(err_msg.format(inpt[:element.start()].count("\n")+1,
-                                             element.start()-inpt.rfind("\n",0, element.start())))
+    def _raise_end_tag_error(source, token, error_string, *args, **kwargs):
+        line, col = source.get_position(token.start)
+        raise HTMLParserError("Unexpected end element on line {}, col {}. {}".format(
+            line, col, error_string.format(*args, **kwargs)))
 
     @staticmethod
-    def _get_next_element(inpt,found_elements):
-        try:
-            return found_elements.next()
-        except StopIteration:
-            return None
+    def _raise_parser_error(source, offset, error_string, *args, **kwargs):
+        line, col = source.get_position(offset)
+        raise HTMLParserError("{} (line {}, col {})".format(
+            error_string.format(*args, **kwargs), line, col))
 
     @classmethod
-    def _parse(cls, inpt, found_elements, prev_match=None, head=None):
-        match = cls._get_next_element(inpt, found_elements)
-        target = None
-        while match:
-            # add text from beore element
-            if prev_match:
-                head.add_text(inpt[prev_match.end():match.start()])
-            else:
-                head.add_text(inpt[:match.start()])
-            # if it is an end element do not return
-            if match.group("end_tag"):
-                # also, confirm it matches parent element
-                if match.group("name").lower()!=head.name.lower():
+    def _iter_events(cls, inpt, tokens, source, start=0, end=None, fragment=False):
+        # only the names of the open elements are needed to check the
+        # structure, so nothing here depends on a tree being built.
+        #
+        # 'start' and 'end' limit the events to part of the input. If
+        # 'fragment' is set, that part must close every element it opens
+        if end is None:
+            end = len(inpt)
+        open_names = []
+        prev_end = start
+        for token in tokens:
+            # yield text from before element
+            if token.start>prev_end:
+                yield HTMLEvent(HTMLEvent.TEXT, start=prev_end, end=token.start, buffer=inpt)
+            prev_end = token.end
+            name = token.name.lower()
+            if token.end_tag:
+                # confirm it matches the open element. When auto-closing, an
+                # end tag for any open ancestor closes the current element
+                if not open_names or name!=open_names[-1].lower():
                     if ((not config.AUTO_CLOSE_ELEMENTS) or 
-                        (not match.group("name").lower() in map(lambda e:e.name.lower(),
-                                                                head.get_parents()))):
-                        if head.name==MASTER_ELEMENT_NAME:
-                            raise HTMLParserError(
-                                "Unexpected end tag, got '{}'".format(
-                                match.group('name'),head.name))
+                        (not name in [n.lower() for n in open_names[:-1]])):
+                        if not open_names:
+                            cls._raise_end_tag_error(source, token,
+                                "Unexpected end tag, got '{}'", token.name)
                         else:
-                            raise HTMLParserError(
-                                "Mismatched end tag, got '{}' expected '{}'".format(
-                                match.group('name'),head.name))
-                return match
+                            cls._raise_end_tag_error(source, token,
+                                "Mismatched end tag, got '{}' expected '{}'",
+                                token.name, open_names[-1])
+                yield HTMLEvent(HTMLEvent.END, open_names.pop(), 
+                                start=token.start, end=token.end)
             # according to https://www.w3.org/TR/2011/WD-html5-20110525/syntax.html#start-tags,
             # any foreign tag can be self-closing. I have made a couple lists of all self closing
             # tags and am using them to validate the html. This method is not ideal
             # and may be changed at a later date.
-            elif match.group("self_closing") or match.group("name").lower() in VOID_ELEMENTS:
-                if (match.group("name").lower() in VOID_ELEMENTS or (match.group("self_closing")
-                  and (match.group("name") in SVG_ELEMENTS or match.group("name") in MATHML_ELEMENTS))):   
-                    # if it is valid, add the element to head   
-                    new_child = Element(match.group("name"),   
-                        **cls._parse_attributes(match.group("attributes")))
-                    new_child._self_closing = True
-                    head.add_child(new_child)
-                    # continue the search
-                    # since this is an open and close element, it should not return
-                    # but instead add a child and continue on
-                    prev_match = match
-                    match = cls._get_next_element(inpt, found_elements)
-                    continue
+            elif token.self_closing or name in VOID_ELEMENTS:
+                if (name in VOID_ELEMENTS or (token.self_closing
+                  and (token.name in SVG_ELEMENTS or token.name in MATHML_ELEMENTS))):   
+                    yield HTMLEvent(HTMLEvent.START, token.name,
+                                    cls._parse_attributes(token.attributes), self_closing=True,
+                                    start=token.start, end=token.end)
+                    yield HTMLEvent(HTMLEvent.END, token.name, start=token.end, end=token.end)
                 else:
-                    raise HTMLParserError(
-                        "'{}' can not have a self closing element".format(match.group("name")))
+                    cls._raise_parser_error(source, token.start,
+                        "'{}' can not have a self closing element", token.name)
             else:
-                target = Element(match.group("name"),
-                    **cls._parse_attributes(match.group("attributes")))
-                head.add_child(target)
-                prev_match = cls._parse(inpt,found_elements,match, target)
-            match = cls._get_next_element(inpt, found_elements)
-        # if we are not at the top levl of recursion yet
-        if head.name != MASTER_ELEMENT_NAME:
-            # if we auto-clos elements, return until everything is closed
-            if config.AUTO_CLOSE_ELEMENTS:
-                if prev_match:
-                    head.add_text(inpt[prev_match.end():])
-                return
+                yield HTMLEvent(HTMLEvent.START, token.name,
+                                cls._parse_attributes(token.attributes),
+                                start=token.start, end=token.end)
+                open_names.append(token.name)
+        if open_names and (fragment or not config.AUTO_CLOSE_ELEMENTS):
+            cls._raise_parser_error(source, end,
+                "Unexpected EOF, expected '{}' element", open_names[-1])
+        # any leftover text goes to the innermost element that is still open
+        if prev_end<end:
+            yield HTMLEvent(HTMLEvent.TEXT, start=prev_end, end=end, buffer=inpt)
+        while open_names:
+            yield HTMLEvent(HTMLEvent.END, open_names.pop(), start=end, end=end)
+
+    @staticmethod
+    def _build(events, head, source=None):
+        # the open elements are kept on an explicit stack rather than the call
+        # stack, so deeply nested documents can not hit the recursion limit
+        stack = [head]
+        for event in events:
+            if event.type==HTMLEvent.TEXT:
+                if event.buffer is not None:
+                    new_text = TextElement.from_span(event.buffer, event.start, event.end)
+                else:
+                    new_text = TextElement(event.text)
+                new_text._set_source(source, event.start, event.end)
+                stack[-1].add_child(new_text)
+            elif event.type==HTMLEvent.START:
+                new_child = Element(event.name, **event.attributes)
+                new_child._self_closing = event.self_closing
+                new_child._set_source(source, event.start)
+                new_child._content_start = event.end
+                stack[-1].add_child(new_child)
+                stack.append(new_child)
             else:
-                raise HTMLParserError("Unexpected EOF, expected '{}' element".format(head.name))
-        # if we are at the top level of recursion
-        else:
-            # add any leftover text at the end
-            if prev_match:
-                head.add_text(inpt[prev_match.end():])
-            # if there are not elements at all, add everything as text
-            # this can not be true if prev_match is not None
-            elif not len(head._children):
-                head.add_text(inpt)
+                stack[-1]._source_end = event.end
+                stack[-1]._content_end = event.start
+                stack.pop()
+                if not stack:
+                    break
         return head
 
+    @classmethod
+    def _parse(cls, inpt, tokens, head=None):
+        source = SourceIndex(inpt)
+        # the head keeps the source so that the tree can be reparsed later
+        head._set_source(source, 0, len(inpt))
+        head._content_start = 0
+        head._content_end = len(inpt)
+        head._text_brackets = tokens.text_brackets
+        return cls._build(cls._iter_events(inpt, tokens, source), head, source)
+
+    @classmethod
+    def _get_buffer(cls, inpt):
+        """ returns something the tokenizer can scan from a string, mmap or 
+        file object
+
+        large files are memory mapped where possible, so they are never read
+        into one string """
+        if isinstance(inpt, (basestring, mmap.mmap)):
+            return inpt
+        try:
+            if (inpt.tell()==0 and 
+                os.fstat(inpt.fileno()).st_size>=cls.MMAP_MIN_SIZE):
+                return mmap.mmap(inpt.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, ValueError, EnvironmentError):
+            # not a real file (or an empty one, which can not be mapped)
+            pass
+        return inpt.read()
+
     @classmethod
     def parse(cls, inpt,head=None):
-        return cls._parse(inpt,re.finditer(cls.HTML_TOKENIZER,inpt),
+        """ parses a string, mmap or file object into an element tree
+
+        The text of the tree is read from the input as it is needed. So if
+        the input is memory mapped (as files of at least MMAP_MIN_SIZE
+        bytes are), the mapping stays open for as long as the tree uses it,
+        and the file must not be changed or truncated until then. Call
+        'release_source' on the tree to stop using the mapping """
+        inpt = cls._get_buffer(inpt)
+        return cls._parse(inpt,HTMLTokenizer(inpt),
             head=head if head else Element(MASTER_ELEMENT_NAME))
+
+    @classmethod
+    def iterparse(cls, inpt):
+        """ yields an HTMLEvent for every start tag, end tag and run of text
+
+        This follows the same rules as 'parse' without building a tree. To 
+        build only part of the tree, pass a start event and this generator to
+        'from_events'. Like 'parse', this accepts a string, mmap or file """
+        inpt = cls._get_buffer(inpt)
+        return cls._iter_events(inpt, HTMLTokenizer(inpt), SourceIndex(inpt))
+
+    @classmethod
+    def from_events(cls, start_event, events, source=None):
+        """ builds the element opened by 'start_event' from the events up to 
+        and including its end event
+
+        if 'source' (a SourceIndex) is given, the elements will record their 
+        positions in it """
+        new_element = Element(start_event.name, **start_event.attributes)
+        new_element._self_closing = start_event.self_closing
+        new_element._set_source(source, start_event.start)
+        new_element._content_start = start_event.end
+        return cls._build(events, new_element, source)
+
+    @staticmethod
+    def _iter_window_tokens(tokenizer, start, end):
+        # the tokens between 'start' and 'end'. If the tokens would not
+        # line up with 'end' the way they do in the rest of the document,
+        # the window can not be parsed on its own
+        inpt = tokenizer.inpt
+        for token in tokenizer.tokenize(start):
+            if token.start>=end:
+                if token.start!=end:
+                    break
+                return
+            if token.end>end:
+                break
+            yield token
+        else:
+            if end==len(inpt):
+                return
+        raise HTMLParserError("Tag crosses the edited region")
+
+    def _get_reparse_window(self, start, end):
+        # the offsets and child indexes of the children that have to be
+        # reparsed for an edit of start:end inside this element
+        first, last = 0, len(self._children)
+        window_start, window_end = self._content_start, self._content_end
+        for i, child in enumerate(self._children):
+            if isinstance(child, TextElement):
+                continue
+            if child._source_end<=start:
+                first, window_start = i+1, child._source_end
+            elif child._source_start>=end:
+                last, window_end = i, child._source_start
+                break
+        return window_start, window_end, first, last
+
+    def reparse(self, start, end, replacement):
+        """ replaces source[start:end] with 'replacement' and reparses only
+        the part of the tree it touched
+
+        This must be called on the head of a parsed tree that has not been 
+        changed since. The children of the smallest element around the edit
+        that are next to it are parsed again and spliced in. When that part 
+        of the document can not be parsed on its own (for example, if the 
+        edit adds an end tag), the edit is widened to the next element out. 
+        Every other element is left as it was, styles included, and only has
+        its source offsets moved.
+
+        returns the element whose children were replaced """
+        old_source = self._source
+        if old_source is None or self._content_start!=0:
+            raise ValueError("reparse requires the head of a parsed element tree")
+        inpt = old_source.text
+        if not 0<=start<=end<=len(inpt):
+            raise ValueError("edit {}:{} is outside the source".format(start, end))
+        new_inpt = inpt[:start]+replacement+inpt[end:]
+        delta = len(replacement)-(end-start)
+        source = SourceIndex(new_inpt)
+
+        # find the elements whose content holds the edit, outermost first
+        path = [self]
+        while True:
+            for child in path[-1]._children:
+                if (not isinstance(child, TextElement) and not child._self_closing and
+                  child._content_start<=start and end<=child._content_end):
+                    path.append(child)
+                    break
+            else:
+                break
+
+        text_brackets = self._text_brackets
+        for depth in range(len(path)-1, -1, -1):
+            element = path[depth]
+            window_start, window_end, first, last = element._get_reparse_window(start, end)
+            tokenizer = HTMLTokenizer(new_inpt)
+            new_head = Element(MASTER_ELEMENT_NAME)
+            try:
+                # a '<' before the window that was text may now start a tag
+                # running into the edit
+                for i in text_brackets[:bisect_left(text_brackets, window_start)]:
+                    if tokenizer._scan_tag(i):
+                        raise HTMLParserError("Text before the edit now starts a tag")
+                self._build(self._iter_events(new_inpt,
+                    self._iter_window_tokens(tokenizer, window_start, window_end+delta),
+                    source, window_start, window_end+delta, True), new_head, source)
+            except HTMLParserError:
+                continue
+            break
+        else:
+            # nothing smaller could be parsed by itself, so parse everything.
+            # An error here is an error in the document, and leaves the tree
+            # as it was
+            element, depth = self, 0
+            window_start, window_end = 0, len(inpt)
+            first, last = 0, len(self._children)
+            tokenizer = HTMLTokenizer(new_inpt)
+            new_head = Element(MASTER_ELEMENT_NAME)
+            self._build(self._iter_events(new_inpt, tokenizer, source), new_head, source)
+
+        old_children = element._children
+        following = old_children[last] if last<len(old_children) else None
+        for child in old_children[first:last]:
+            element._unlink_child(child)
+        for child in new_head._children:
+            element._link_child(child, following)
+        self._text_brackets = (text_brackets[:bisect_left(text_brackets, window_start)]+
+            [i for i in tokenizer.text_brackets if i<window_end+delta]+
+            [i+delta for i in text_brackets[bisect_left(text_brackets, window_end):]])
+
+        # move the offsets of the old elements over to the new source. The
+        # elements around the edit only end later, the ones after it move
+        ancestors = set(map(id, path[:depth+1]))
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node._source is not old_source:
+                continue
+            node._source = source
+            if id(node) in ancestors:
+                node._source_end += delta
+                node._content_end += delta
+            elif node._source_start>=end:
+                node._source_start += delta
+                node._source_end += delta
+                if node._content_start is not None:
+                    node._content_start += delta
+                    node._content_end += delta
+            if isinstance(node, TextElement):
+                if node._buffer is inpt:
+                    node._buffer = new_inpt
+                    node._start, node._end = node._source_start, node._source_end
+            else:
+                stack.extend(node._children)
+        return element
        
-    def render(self, _inline_style=False):
-        output_string = ""
-        dq_format = '{}="{}"'
-        sq_format = "{}='{}'"
-        if self.name!=MASTER_ELEMENT_NAME:
-            output_string = "<{}".format(self.name)
-            key=val=None
-            for key,val in sorted(self._attributes.items()):
-                output_string += " "
-                if key and val:
-                    if '"' in val:
-                        if "'" in val:
-                            # any anttribute with both types of quotes should crash
-                            # during parsing, but if for some reason a string
-                            # makes it through, this will handle it correctly
-                            output_string += dq_format.format(key,
-                                val.replace('"',"&quot;"))
-                        else:
-                            output_string += sq_format.format(key,val)
+    def release_source(self):
+        """ copies the text of this element and everything below it out of
+        a memory mapped source, so it no longer reads from the mapped file
+
+        The mapping is closed once nothing else (such as a fork) uses it. 
+        The copies are shared, so the tree can still be reparsed """
+        copies = {}
+        def get_copy(buffer):
+            if id(buffer) not in copies:
+                # the buffer is kept with its copy, so its id is not reused
+                copies[id(buffer)] = (buffer, buffer[:])
+            return copies[id(buffer)][1]
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node._source is not None and isinstance(node._source.text, mmap.mmap):
+                node._source.text = get_copy(node._source.text)
+            if isinstance(node, TextElement):
+                if isinstance(node._buffer, mmap.mmap):
+                    node._buffer = get_copy(node._buffer)
+            else:
+                stack.extend(node._children)
+        return self
+
+    def serialize(self):
+        """ returns the element and everything below it as a string that 
+        Element.deserialize turns back into the same tree
+
+        Names, attributes, self-closing flags, text and applied styles are 
+        kept. Source offsets are not, so the loaded tree can not be reparsed.
+        The tree is written as a flat list of elements in document order, 
+        each with its number of children, so any depth of tree can be 
+        written and read """
+        records = []
+        stack = [self]
+        while stack:
+            element = stack.pop()
+            if isinstance(element, TextElement):
+                records.append(element.text)
+            else:
+                children = element._children
+                records.append((element._name, element._attributes, element._self_closing,
+                                element._styles, element._inline_style, len(children)))
+                stack.extend(reversed(children))
+        return pickle.dumps((SERIAL_VERSION, reserve_instance_numbers(0), records),
+                            pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def deserialize(cls, data):
+        """ returns the tree written by Element.serialize """
+        version, instance_counter, records = pickle.loads(data)
+        if version!=SERIAL_VERSION:
+            raise ValueError("Serialized tree has version {}, expected {}".format(
+                version, SERIAL_VERSION))
+        # styles made from now on must sort after the loaded ones, as if they
+        # had been made in this process
+        reserve_instance_numbers(0, instance_counter)
+        root = None
+        # the open elements, with the number of children they are still owed
+        stack = []
+        for record in records:
+            if isinstance(record, basestring):
+                new_element = TextElement(record)
+                child_count = 0
+            else:
+                name, attributes, self_closing, styles, inline_style, child_count = record
+                new_element = Element(name)
+                new_element._attributes = {intern_symbol(k):v for k,v in attributes.items()}
+                new_element._self_closing = self_closing
+                new_element._styles = styles
+                new_element._inline_style = inline_style
+            if stack:
+                stack[-1][0]._link_child(new_element)
+                stack[-1][1] -= 1
+                if not stack[-1][1]:
+                    stack.pop()
+            else:
+                root = new_element
+            if child_count:
+                stack.append([new_element, child_count])
+        return root
+
+    def _render_start_tag(self, minify=False):
+        output = ["<", self.name]
+        key=val=None
+        unquoted = False
+        for key,val in sorted(self._attributes.items()):
+            unquoted = False
+            if key and val:
+                if minify and self.UNQUOTED_VALUE.match(val):
+                    output.append(" {}={}".format(key,val))
+                    unquoted = True
+                elif '"' in val:
+                    if "'" in val:
+                        # any anttribute with both types of quotes should crash
+                        # during parsing, but if for some reason a string
+                        # makes it through, this will handle it correctly
+                        output.append(' {}="{}"'.format(key, val.replace('"',"&quot;")))
                     else:
-                        output_string += dq_format.format(key,val)
+                        output.append(" {}='{}'".format(key,val))
                 else:
-                    output_string += key                 
-            if self.name in VOID_ELEMENTS or self._self_closing:
-                if key or val:
-                    output_string += " />"
+                    output.append(' {}="{}"'.format(key,val))
+            else:
+                output.append(" "+key)
+        if minify and self.name in VOID_ELEMENTS:
+            output.append(">")
+        elif self.name in VOID_ELEMENTS or self._self_closing:
+            # an unquoted value would take in the '/'
+            if (key or val) and (unquoted or not minify):
+                output.append(" />")
+            else:
+                output.append("/>")
+        else:
+            output.append(">")
+        return "".join(output)
+
+    def iter_render(self, minify=False):
+        """ yields the html of the element and everything below it in chunks
+        of about RENDER_BUFFER_SIZE characters
+
+        The tree is walked with an explicit stack, with the end tags waiting
+        on it behind the children, so the whole document is never built up 
+        as one string.
+
+        If 'minify' is True, runs of whitespace in text are collapsed to one
+        space, whitespace that can not show (between two block elements, for
+        instance) is dropped, quotes are left off attribute values that do 
+        not need them and void elements are not closed. Whitespace inside 
+        PRESERVE_WHITESPACE_ELEMENTS is left as it is """
+        pieces = []
+        size = 0
+        add = pieces.append
+        # the number of elements being rendered that keep their whitespace.
+        # Each has a marker on the stack, under its children, to count it out
+        preserving = 0
+        leave_preserved = Element._PRESERVE_MARKER
+        stack = [self]
+        pop, append, extend = stack.pop, stack.append, stack.extend
+        while stack:
+            item = pop()
+            # the end tags are strings
+            if item.__class__ is str or isinstance(item, unicode):
+                piece = item
+            elif isinstance(item, TextElement):
+                if minify and not preserving:
+                    piece = item._get_minified_text()
+                    if not piece:
+                        continue
                 else:
-                    output_string += "/>"   
-            else:   
-                output_string += ">" 
-        if not (self.name in VOID_ELEMENTS or self._self_closing): 
-            for child in self._children:
-                output_string += child.render(_inline_style)
-            if self.name!=MASTER_ELEMENT_NAME:
-                output_string+="</{}>".format(self.name)
-        return output_string   
-   
+                    piece = item.text
+            elif item is leave_preserved:
+                preserving -= 1
+                continue
+            else:
+                name = item._name
+                if not (name in VOID_ELEMENTS or item._self_closing):
+                    if name!=MASTER_ELEMENT_NAME:
+                        append("</"+name+">")
+                    if minify and item.tag_name in PRESERVE_WHITESPACE_ELEMENTS:
+                        preserving += 1
+                        append(leave_preserved)
+                    extend(reversed(item._children))
+                if name==MASTER_ELEMENT_NAME:
+                    continue
+                piece = item._render_start_tag(minify)
+            add(piece)
+            size += len(piece)
+            if size>=RENDER_BUFFER_SIZE:
+                yield "".join(pieces)
+                del pieces[:]
+                size = 0
+        if pieces:
+            yield "".join(pieces)
+
+    def render_to(self, stream, encoding=None, minify=False):
+        """ writes the html of the element and everything below it to the 
+        file-like 'stream', a chunk at a time
+
+        If 'encoding' is given, unicode text is encoded with it before it is
+        written. See 'iter_render' for 'minify' """
+        for chunk in self.iter_render(minify):
+            if encoding is not None and isinstance(chunk, unicode):
+                chunk = chunk.encode(encoding)
+            stream.write(chunk)
+
+    def render(self, minify=False):
+        return "".join(self.iter_render(minify))
+
 
 
 class TextElement(Element,object):
+    NON_WHITESPACE = re.compile(r"\S")
+    WHITESPACE = re.compile(r"\s+")
+    # below this, slicing out a short lived copy is faster than a search
+    SEARCH_SPAN_LENGTH = 256
+
+    __slots__ = ("_text", "_buffer", "_start", "_end")
+
     def __init__(self, text, parent=None, **attributes):
         super(TextElement,self).__init__("", parent, **attributes)
         self.text = text
 
+    @classmethod
+    def from_span(cls, buffer, start, end, parent=None):
+        """ creates a text element for buffer[start:end] without copying it
+
+        The string is only built when 'text' is read or the element is
+        rendered, so the whitespace between tags costs no more than the
+        reference to the buffer """
+        new_text = cls("", parent)
+        new_text._buffer = buffer
+        new_text._start = start
+        new_text._end = end
+        return new_text
+
+    @property
+    def text(self):
+        if self._buffer is None:
+            return self._text
+        return self._buffer[self._start:self._end]
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+        self._buffer = None
+        self._start = None
+        self._end = None
+
+    def _fork_element(self):
+        # strings are never changed in place, so text is always shared
+        new_text = super(TextElement,self)._fork_element()
+        new_text._text = self._text
+        new_text._buffer = self._buffer
+        new_text._start = self._start
+        new_text._end = self._end
+        return new_text
+
     def __repr__(self):
-        return "HTMLText({} chars)".format(len(self.text))
+        if self._buffer is None:
+            return "HTMLText({} chars)".format(len(self._text))
+        return "HTMLText({} chars)".format(self._end-self._start)
 
     def __str__(self):
         return self.__repr__()
 
     def _get_empty(self, first_call=True):
-        return not bool(self.text.strip())
+        if (self._buffer is None or isinstance(self._buffer, unicode) or
+            self._end-self._start<self.SEARCH_SPAN_LENGTH):
+            return not bool(self.text.strip())
+        # long spans are searched in place rather than sliced and stripped
+        return not self.NON_WHITESPACE.search(self._buffer, self._start, self._end)
 
     @classmethod
-    def _parse(cls, inpt, found_elements=None, prev_match=None, head=None):
-        return TextElement(inpt, parent=head)
+    def _parse(cls, inpt, tokens=None, head=None):
+        return TextElement.from_span(inpt, 0, len(inpt), parent=head)
+
+    def _next_to_inline(self, sibling):
+        # whether whitespace next to 'sibling' (or the edge of the parent, if
+        # it is None) could show up
+        if sibling is None:
+            return self.parent is not None and self.parent.tag_name not in BLOCK_ELEMENTS
+        return isinstance(sibling, TextElement) or sibling.tag_name not in BLOCK_ELEMENTS
+
+    def _get_minified_text(self):
+        text = self.text
+        if self.NON_WHITESPACE.search(text):
+            return self.WHITESPACE.sub(" ", text)
+        if text and (self._next_to_inline(self._prev) or self._next_to_inline(self._next)):
+            return " "
+        return ""
 
-    def render(self, _inline_style=False):
+    def render(self, minify=False):
+        if minify:
+            return self._get_minified_text()
         return self.text
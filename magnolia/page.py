@@ -3,12 +3,28 @@ import warnings
 
 import html
 import css
+from cache import TreeCache, StyleSheetCache, STYLESHEETS
+from configs import config
 
 class IOWarning(Warning):
     pass
 
 class HTMLPreprocessor:
-    def __init__(self, fileName, root=None, path=[]):
+    """ loads an html file and the stylesheets it uses
+
+    If 'cache_dir' is given, the styled tree is kept there by 'apply_css',
+    and 'load' reads it back while the file and all of its stylesheets are 
+    unchanged. A tree loaded like this is already styled, so its 
+    stylesheets are not read and 'apply_css' does nothing. Otherwise, the
+    linked stylesheets are parsed once and kept in the 'stylesheets' 
+    directory under 'cache_dir', to be shared by every file that links to
+    them.
+
+    Linked stylesheets are read through cache.STYLESHEETS, so within one
+    process each is only parsed once for every HTMLPreprocessor, until the
+    file changes. Those stylesheets are shared, and are not changed by
+    'apply_css' """
+    def __init__(self, fileName, root=None, path=[], cache_dir=None):
         self.fileName = fileName
         self.base = os.path.dirname(os.path.abspath(fileName))
         if root:
@@ -25,8 +41,19 @@ class HTMLPreprocessor:
         self.path = [os.path.normpath(os.path.expandvars(os.path.expanduser(p))) 
                         for p in self.path]
         self.element_tree = None
+        # the stylesheets the page uses. This stays empty when 'load' finds
+        # the styled tree in the cache, as they are not read then
         self.stylesheets = []
 
+        self.cache = TreeCache(cache_dir) if cache_dir else None
+        self.stylesheet_cache = None
+        if cache_dir:
+            self.stylesheet_cache = StyleSheetCache(os.path.join(cache_dir, "stylesheets"))
+        self._cache_key = None
+        self._cached = False
+        # the (path, content hash) of every stylesheet that was read
+        self._sources = []
+
     def _get_segments(self, p):
         out = []
         while p.endswith('/') or p.endswith('\\'):
@@ -79,15 +106,16 @@ class HTMLPreprocessor:
                 else:
                     fname = self._search_path(fname)
                 stylesheet_path = os.path.abspath(os.path.normpath(fname))
-                stylesheet_text = None
                 try:
-                    with open(stylesheet_path,'r') as f:
-                        stylesheet_text = f.read()
+                    new_stylesheet, content_hash = STYLESHEETS.get(stylesheet_path,
+                        self.stylesheet_cache)
                 except IOError:
                     warnings.warn("Could not read from '{}'".format(stylesheet_path),IOWarning)
-                if stylesheet_text:
-                    new_stylsheet = css.StyleSheet.parse(stylesheet_text,src=stylesheet_path)
-                    self.stylesheets.append(new_stylsheet)
+                    new_stylesheet = content_hash = None
+                if self.cache is not None:
+                    self._sources.append((stylesheet_path, content_hash))
+                if new_stylesheet is not None:
+                    self.stylesheets.append(new_stylesheet)
         elif tag.name == "style":
             content = ""
             for child in tag._children:
@@ -96,12 +124,28 @@ class HTMLPreprocessor:
                 self.stylesheets.append(css.StyleSheet.parse(content))
 
     def load(self):
-        with open(os.path.join(self.root, self.fileName), 'r') as f:
-            data = f.read()
-        self.element_tree = html.Element.parse(data)
+        fname = os.path.join(self.root, self.fileName)
+        if self.cache is not None:
+            with open(fname, 'rb') as f:
+                document = f.read()
+            self._cache_key = self.cache.get_key(document, self.base, self.root,
+                config.AUTO_CLOSE_ELEMENTS, *self.path)
+            self.element_tree = self.cache.load(self._cache_key)
+            self._cached = self.element_tree is not None
+            if self._cached:
+                return self
+            self.element_tree = html.Element.parse(document)
+        else:
+            # the file is passed straight to the parser so it can be memory mapped
+            with open(fname, 'rb') as f:
+                self.element_tree = html.Element.parse(f)
         self.element_tree.map(self._handle_tag)
         return self
 
     def apply_css(self):
+        if self._cached:
+            return
         self.element_tree.apply_styles(*self.stylesheets)
-        self.element_tree.apply_styles()
\ No newline at end of file
+        self.element_tree.apply_styles()
+        if self.cache is not None:
+            self.cache.store(self._cache_key, self.element_tree, self._sources)
\ No newline at end of file
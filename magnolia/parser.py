@@ -4,6 +4,7 @@ import inspect
 import page
 from configs import config
 from css import Selector
+from html import Element
 
 class HTMLTestError(Exception):
     pass
@@ -30,8 +31,10 @@ class Parser:
 
     main.render()
     """
-    def __init__(self, project_dir, path=[]):
+    def __init__(self, project_dir, path=[], cache_dir=None):
         self.project_dir = project_dir
+        # where styled trees are cached between runs (see HTMLPreprocessor)
+        self.cache_dir = cache_dir
         if isinstance(path, list):
             self.path = path
         elif hasattr(path, "__iter__"):
@@ -49,8 +52,8 @@ class Parser:
         if selector:
             if isinstance(selector,str):
                 selector_obj = Selector.parse(selector)
-            elif not isinstance(selector, Selector):
-                selector_obj = None
+            elif isinstance(selector, Selector):
+                selector_obj = selector
         return selector_obj
 
     def html_rule(self,selector=None,pass_num=0):
@@ -70,7 +73,8 @@ class Parser:
             @functools.wraps(func)
             def inner(element):
                 if not selector_obj or selector_obj.match(element):
-                    if element and (not element.has_parent() or element.get_parent().has_child(element)):
+                    if element and not element.is_detached() and \
+                      (not element.has_parent() or element.get_parent().has_child(element)):
                         return func(element)
 
             # add the new function to the list of rules
@@ -98,12 +102,20 @@ class Parser:
 
     def render(self, fname):
         print "Generatig html/css trees"
-        html_page = page.HTMLPreprocessor(fname, root=self.project_dir, path=self.path).load()
+        html_page = page.HTMLPreprocessor(fname, root=self.project_dir, path=self.path,
+                                          cache_dir=self.cache_dir).load()
         print "Applying css"
         html_page.apply_css()
         print "Applying html rules"
 
         priority_list = sorted(self._render_rules.items(), key=lambda r: r[0])
         for priority,rules in priority_list:
-            html_page.element_tree.map(lambda tag: self._func_caller(tag,rules))
+            # elements removed by a rule are only marked as detached, and are
+            # taken out of the tree once every element has been through the
+            # pass. Nothing below a removed element is visited, but until the
+            # pass ends, removed elements are still found by the queries and
+            # sibling methods of the elements around them
+            with html_page.element_tree.batch():
+                for tag in html_page.element_tree.walk(prune=Element.is_detached):
+                    self._func_caller(tag,rules)
         return html_page.element_tree
\ No newline at end of file
@@ -1 +1,2 @@
-from _tests import run
\ No newline at end of file
+from _tests import run
+from _benchmarks import run as run_benchmarks
@@ -0,0 +1,730 @@
+from __future__ import print_function
+import os
+import re
+import shutil
+import string
+import sys
+import tempfile
+import timeit
+
+from .. import cache
+from .. import css
+from .. import html
+from .. import page
+from ..configs import config
+
+
+FILE_TEMPLATE  = "Benchmarking '{}':"
+GROUP_TEMPLATE = " +- Benchmarking {}"
+RESULT_TEMPLATE = " |    {:<40} {:>10.2f} ms/run {}"
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+
+
+def _read_fixture(name):
+    with open(os.path.join(FIXTURE_DIR, name), 'r') as f:
+        return f.read()
+
+def bench(msg, stmt, number=10, note=""):
+    """ runs 'stmt' 'number' times (best of 3) and prints the time per run """
+    best = min(timeit.repeat(stmt, number=number, repeat=3))
+    per_run = best/number
+    print(RESULT_TEMPLATE.format(msg, per_run*1000, note))
+    return per_run
+
+
+# The regex tokenizer and recursive tree builder that html.Element used before
+# HTMLTokenizer. It is kept here so the two can be compared.
+LEGACY_HTML_TOKENIZER = re.compile(r"<\s*(?P<end_tag>/)?"
+                    r"\s*(?P<name>[^\s\0\"'></=]+)\s*"
+                    r"(?P<attributes>(?:[^\s\0\"'></=]+"
+                    r"(?:\s*=\s*(?:(?P<oq>['\"])[^\4]*?(?P=oq)|(?P<unquot>[^\s\0\"'></=]+)))?\s*?)*)"
+                    r"(?P<self_closing>(?:(?(unquot)\s)\s*?/)?)\s*>",re.DOTALL)
+
+def _legacy_parse(inpt, found_elements, prev_match=None, head=None):
+    match = next(found_elements, None)
+    while match:
+        if prev_match:
+            head.add_text(inpt[prev_match.end():match.start()])
+        else:
+            head.add_text(inpt[:match.start()])
+        if match.group("end_tag"):
+            if match.group("name").lower()!=head.name.lower():
+                if ((not config.AUTO_CLOSE_ELEMENTS) or 
+                    (not match.group("name").lower() in map(lambda e:e.name.lower(),
+                                                            head.get_parents()))):
+                    raise html.HTMLParserError("Mismatched end tag")
+            return match
+        elif match.group("self_closing") or match.group("name").lower() in html.VOID_ELEMENTS:
+            new_child = html.Element(match.group("name"),   
+                **html.Element._parse_attributes(match.group("attributes")))
+            new_child._self_closing = True
+            head.add_child(new_child)
+            prev_match = match
+            match = next(found_elements, None)
+            continue
+        else:
+            target = html.Element(match.group("name"),
+                **html.Element._parse_attributes(match.group("attributes")))
+            head.add_child(target)
+            prev_match = _legacy_parse(inpt,found_elements,match, target)
+        match = next(found_elements, None)
+    if head.name != html.MASTER_ELEMENT_NAME:
+        if prev_match:
+            head.add_text(inpt[prev_match.end():])
+        return
+    if prev_match:
+        head.add_text(inpt[prev_match.end():])
+    elif not len(head._children):
+        head.add_text(inpt)
+    return head
+
+def legacy_parse(inpt):
+    return _legacy_parse(inpt, re.finditer(LEGACY_HTML_TOKENIZER, inpt),
+                         head=html.Element(html.MASTER_ELEMENT_NAME))
+
+
+# The character by character attribute parser that html.Element used before
+# ATTRIBUTE_TOKENIZER
+def legacy_parse_attributes(attribute_string):
+    if not attribute_string:
+        return {}
+    else:
+        # we're parsing this baby
+        # parsing as per https://www.w3.org/TR/2011/WD-html5-20110525/syntax.html#syntax-attribute-name
+        attrs = {}
+        k=i=0
+        attr = val = ""
+        string_char=None
+        update_k = False
+        passed_whitespace = False
+        waiting_for_value = False
+        while i<len(attribute_string):
+            if (attribute_string[i] in "'\"" and (not string_char
+              or attribute_string[i]==string_char)):
+                if not attr:
+                    raise html.HTMLParserError("Unexpected string encountered in element attribute")
+                elif string_char:
+                    val = attribute_string[k:i]
+                    if attr:
+                        attrs[attr]=val
+                        attr=val=""
+                    else:
+                        raise html.HTMLParserError("Attribute value encountered before name")
+                    string_char = None
+                else:
+                    string_char = attribute_string[i]
+                update_k = True
+
+            elif string_char:
+                # if we are in a string
+                #
+                # note: there are very few rules for strings that I will 
+                #       be enforcing at the moment, so ignore all 
+                #       characters in string
+                pass
+
+            elif attribute_string[i] in string.whitespace:
+                # if we are in unquoted value and encounter whitespace
+                passed_whitespace = True
+
+            elif attribute_string[i]=="=":
+                if attr:
+                    raise html.HTMLParserError("Unexpected '=' encountered,"
+                                          " expected attribute value")
+                else:
+                    attr = attribute_string[k:i].strip()
+                    update_k = True
+                    waiting_for_value = True
+                    passed_whitespace = False
+
+            # checking for some of these characters is redundant, but this
+            # is done for consistency with the W3C html5 specs (at least
+            # as much as possible)
+            elif not string_char and attribute_string[i] in "'\"=<>`\0":
+                raise html.HTMLParserError("Invalid attribute character '{}' encountered".format(
+                    attribute_string[i]))
+            else:
+                # this should only be unquoted valid chars
+                if passed_whitespace:
+                    if waiting_for_value and attribute_string[k:i].strip() and attr:
+                        attrs[attr] = attribute_string[k:i].strip()
+                        attr=val=""
+                        k=i
+                    elif attribute_string[k:i].strip():
+                        attr = attribute_string[k:i].strip()
+                        # this needs to be changed to 'None' eventually
+                        attrs[attr] = ""
+                        attr=val=""
+                        k=i
+                    passed_whitespace = False
+            i+=1
+            if update_k:
+                k=i
+                update_k = False
+        if k<len(attribute_string):
+            if attribute_string[k:i].strip():
+                if attr:
+                    attrs[attr]=attribute_string[k:i].strip()
+                else:
+                    attrs[attribute_string[k:i].strip()]=""
+        return attrs
+
+
+# The character loop that CSSAbstract._parse_css used before CSS_SYNTAX. It
+# copies the rest of the stylesheet after every rule
+def legacy_parse_css(inpt):
+    def unescaped_char(sub_string,i):
+        return inpt[i]==sub_string and (i==0 or (i>0 and inpt[i-1]!="\\"))
+    inpt = inpt.strip()
+    while inpt:
+        # i = hs = he = ts = te = 0
+        k=i=0
+        head = tail = ""
+        in_comment = False
+        at_rule = False
+        string_start = None
+        while i<len(inpt):
+            if in_comment:
+                if inpt[i-2:i]=="*/":
+                    k=i
+                    in_comment = False
+            else:
+                if inpt[i:i+2]=="/*":
+                    head += inpt[k:i]
+                    in_comment = True
+                    continue
+                elif unescaped_char('"',i) or unescaped_char("'",i):
+                    # strings are treated somewhat like comments,
+                    # in that css constructs inside them are ignored
+                    if string_start:
+                        if inpt[i]==string_start:
+                            string_start = None
+                    else:
+                        string_start = inpt[i]    
+                elif inpt[i]=='{':
+                    break
+                elif inpt[i]=='@':
+                    at_rule=True
+                elif at_rule and inpt[i]==";":
+                    break
+            i+=1
+        head += inpt[k:i]
+        if i>=len(inpt):
+            raise StopIteration
+        # i is now at first valid { or ;
+        if inpt[i]==";":
+            yield css._abstract.CSSToken(inpt[:i+1],head,"",i+1, False)
+            inpt = inpt[i+1:]
+            continue
+        # he = i
+        k = i+1 if i!=len(inpt)-1 else i
+        nest_layer = 1
+        while i<len(inpt):
+            i += 1
+            if in_comment:
+                if inpt[i-2:i]=="*/":
+                    k=i
+                    in_comment = False
+            else:
+                if inpt[i:i+2]=="/*":
+                    tail+=inpt[k:i]
+                    in_comment=True
+                    continue
+                elif unescaped_char('"',i) or unescaped_char("'",i):
+                    if string_start:
+                        if inpt[i]==string_start:
+                            string_start = None
+                    else:
+                        string_start = inpt[i]  
+                elif not string_start:
+                    if inpt[i]=="}" and (i==0 or (i>0 and inpt[i-1]!="\\")):
+                        nest_layer -= 1
+                        if nest_layer<=0:
+                            break
+                    elif inpt[i]=="{" and (i==0 or (i>0 and inpt[i-1]!="\\")):
+                        nest_layer +=1
+        tail += inpt[k:i]
+        yield css._abstract.CSSToken(inpt[:i+1].strip(),head.strip(),tail.strip(),i,True)
+        inpt = inpt[i+1:].strip()
+
+
+# How Selector.parse used to build selector chains: the tokens before the last
+# one are joined back into a string and parsed again, once per combinator
+def legacy_parse_selector(inpt):
+    inpt = inpt.strip()
+    tokens = css.Selector._tokenize_selector(inpt)
+    element = tokens[-1]
+    tail = css.static.Element.parse(''.join([element.type, element.name,
+                                  element.attribute, element.pseudo_class, 
+                                  element.pseudo_element]))
+    if len(tokens)>1:
+        conn_type = css.Selector.CONN_TYPES.get(tokens[-2].conn_type, css.Selector.HAS_ALSO)
+        selector_string = ''.join([t.joined() for t in tokens[:-1]])
+        if len(tokens)<=2:
+            head = css.static.Element.parse(selector_string)
+        else:
+            head = legacy_parse_selector(selector_string)
+    else:
+        head = None
+        conn_type = None
+    return css.Selector(tail,conn_type,head)
+
+
+# The recursive renderer that html.Element used before iter_render
+def legacy_render(element):
+    if isinstance(element, html.TextElement):
+        return element.text
+    output_string = ""
+    if element.name!=html.MASTER_ELEMENT_NAME:
+        output_string = element._render_start_tag()
+    if not (element.name in html.VOID_ELEMENTS or element._self_closing): 
+        for child in element._children:
+            output_string += legacy_render(child)
+        if element.name!=html.MASTER_ELEMENT_NAME:
+            output_string+="</{}>".format(element.name)
+    return output_string
+
+
+def bench_html_parse():
+    print(GROUP_TEMPLATE.format("Element.parse"))
+    data = _read_fixture("main.html")
+    size = len(data)/1024.0
+    bench("regex tokenizer (main.html)",
+          lambda: list(re.finditer(LEGACY_HTML_TOKENIZER, data)))
+    bench("HTMLTokenizer tokens (main.html)", lambda: list(html.HTMLTokenizer(data)))
+    legacy = bench("regex parser (main.html)", lambda: legacy_parse(data))
+    current = bench("HTMLTokenizer (main.html)", lambda: html.Element.parse(data))
+    print(" |    throughput: {:.0f} KiB/s -> {:.0f} KiB/s".format(size/legacy, size/current))
+
+    # an unfinished tag full of quoted values makes the regex try every way of
+    # splitting the values up, which grows exponentially with the attributes
+    for count in (6, 8, 10):
+        broken = "<td "+" ".join('a{}="x"'.format(n) for n in range(count))+" ="
+        bench("regex tokenizer ({} quoted attributes)".format(count),
+              lambda: list(re.finditer(LEGACY_HTML_TOKENIZER, broken)), 1)
+        bench("HTMLTokenizer ({} quoted attributes)".format(count),
+              lambda: list(html.HTMLTokenizer(broken)), 1)
+
+    # nested deeper than the interpreter's recursion limit
+    depth = sys.getrecursionlimit()*2
+    nested = "<table><tr><td>"*depth + "</td></tr></table>"*depth
+    try:
+        legacy_parse(nested)
+    except RuntimeError:
+        print(" |    regex parser (depth {}): recursion limit exceeded".format(depth))
+    bench("HTMLTokenizer (depth {})".format(depth), lambda: html.Element.parse(nested), 1)
+
+
+def bench_html_iterparse():
+    print(GROUP_TEMPLATE.format("Element.iterparse"))
+    data = _read_fixture("main.html")
+
+    def collect_from_tree():
+        urls = []
+        for element in html.Element.parse(data).filter(lambda e: True):
+            for attribute in ("href", "src", "data"):
+                if element.has_attribute(attribute):
+                    urls.append(element.get_attribute(attribute))
+        return urls
+
+    def collect_from_events():
+        urls = []
+        for event in html.Element.iterparse(data):
+            for attribute in ("href", "src", "data"):
+                if attribute in event.attributes:
+                    urls.append(event.attributes[attribute])
+        return urls
+
+    bench("parse + filter (main.html urls)", collect_from_tree)
+    bench("iterparse (main.html urls)", collect_from_events)
+
+
+def bench_html_parse_attributes():
+    print(GROUP_TEMPLATE.format("Element._parse_attributes"))
+    data = _read_fixture("main.html")
+    attribute_strings = [t.attributes for t in html.HTMLTokenizer(data) if t.attributes]
+    print(" |    {} attribute strings, {} chars".format(len(attribute_strings),
+                                                   sum(map(len, attribute_strings))))
+    bench("character loop (main.html)",
+          lambda: [legacy_parse_attributes(a) for a in attribute_strings])
+    bench("ATTRIBUTE_TOKENIZER (main.html)",
+          lambda: [html.Element._parse_attributes(a) for a in attribute_strings])
+
+
+def bench_source_positions():
+    print(GROUP_TEMPLATE.format("Element.get_source_position"))
+    data = _read_fixture("main.html")*40
+    tree = html.Element.parse(data)
+    elements = tree.filter(lambda e: e.get_source_span() is not None)
+    sample = elements[::len(elements)//200]
+    print(" |    {:.1f} MiB input, {} elements".format(len(data)/1048576.0, len(elements)))
+
+    def count_newlines():
+        for element in sample:
+            start = element.get_source_span()[0]
+            (data[:start].count("\n")+1, start-data.rfind("\n",0,start))
+
+    def source_index():
+        for element in sample:
+            element.get_source_position()
+
+    bench("slice and count ({} elements)".format(len(sample)), count_newlines, 1)
+    bench("SourceIndex ({} elements)".format(len(sample)), source_index, 1)
+    bench("SourceIndex (all elements)",
+          lambda: [e.get_source_position() for e in elements], 1)
+
+
+def bench_interned_symbols():
+    print(GROUP_TEMPLATE.format("interned symbols"))
+    data = _read_fixture("main.html")*10
+    elements = html.Element.parse(data).filter(lambda e: True)
+    # before interning, each element kept its own copies of its name and
+    # attribute names. Now those, the lowercased name and the class names all
+    # come from the shared table
+    copied = []
+    shared = {}
+    for element in elements:
+        names = [element.name]+element._attributes.keys()
+        copied.extend(names)
+        for name in names+[element.tag_name]+list(element.get_classes()):
+            shared[id(name)] = name
+    copied_size = sum(sys.getsizeof(name) for name in copied)
+    shared_size = sum(sys.getsizeof(name) for name in shared.values())
+    print(" |    {} elements: {:.0f} KiB of name copies -> {:.0f} KiB shared".format(
+        len(elements), copied_size/1024.0, shared_size/1024.0))
+
+    selector = css.Selector.parse(".container div")
+    bench("Selector.match (main.html x10)",
+          lambda: [selector.match(e) for e in elements], 1)
+
+def bench_file_input():
+    print(GROUP_TEMPLATE.format("file input"))
+    data = _read_fixture("main.html")*10
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(data)
+        f.flush()
+        def read_then_parse():
+            with open(f.name, 'rb') as source:
+                return html.Element.parse(source.read())
+        def parse_file():
+            with open(f.name, 'rb') as source:
+                return html.Element.parse(source)
+        bench("read() then parse (main.html x10)", read_then_parse, 1)
+        bench("parse mmapped file (main.html x10)", parse_file, 1)
+
+def bench_text_spans():
+    print(GROUP_TEMPLATE.format("text spans"))
+    data = _read_fixture("main.html")*10
+    texts = html.Element.parse(data).filter(lambda e: True)
+    texts = [child for e in texts for child in e._children if isinstance(child, html.TextElement)]
+    # each text element used to hold its own slice of the input
+    copied_size = sum(sys.getsizeof(data[t._start:t._end]) for t in texts)
+    print(" |    {} text elements: {:.0f} KiB of copies -> 0 KiB with spans".format(
+        len(texts), copied_size/1024.0))
+    bench("render text (main.html x10)", lambda: [t.render() for t in texts], 1)
+def bench_reparse():
+    print(GROUP_TEMPLATE.format("incremental reparse"))
+    data = _read_fixture("main.html")*10
+    tree = html.Element.parse(data)
+    # a one character edit in the text of the first paragraph
+    offset = data.index(">", data.index("<p"))+1
+    bench("parse after edit (main.html x10)", lambda: html.Element.parse(data), 1)
+    bench("reparse edit (main.html x10)", lambda: tree.reparse(offset, offset+1, "x"), 1)
+
+def bench_node_size():
+    print(GROUP_TEMPLATE.format("node size"))
+    tree = html.Element.parse(_read_fixture("main.html"))
+    elements = tree.filter(lambda e: True)
+    def node_size(e):
+        # before __slots__, each node also had a __dict__ of about 1 KiB
+        if hasattr(e, "__dict__"):
+            return sys.getsizeof(e)+sys.getsizeof(e.__dict__)
+        return sys.getsizeof(e)
+    size = sum(node_size(e) for e in elements)
+    print(" |    {} elements: {:.0f} bytes per element".format(len(elements),
+        size/float(len(elements))))
+    bench("map (main.html)", lambda: tree.map(lambda e: None), 10)
+    bench("filter (main.html)", lambda: tree.filter(lambda e: e.name=="div"), 10)
+    bench("render (main.html)", tree.render, 10)
+    # each of these used to parse an empty style and make a stylesheet
+    bench("Element() x1000", lambda: [html.Element("div") for i in range(1000)], 10)
+    bench("TextElement() x1000", lambda: [html.TextElement("") for i in range(1000)], 10)
+
+def bench_structural_selectors():
+    print(GROUP_TEMPLATE.format("structural selectors"))
+    tree = html.Element.parse("<ul>{}</ul>".format("<li>item</li>\n"*2000))
+    items = tree.filter(lambda e: e.name=="li")
+    for selector_string in ("li:nth-child(2n)", "li:last-of-type", "li + li"):
+        selector = css.Selector.parse(selector_string)
+        bench("{} (2000 siblings)".format(selector_string),
+              lambda: [selector.match(e) for e in items], 1)
+
+def bench_wide_elements():
+    print(GROUP_TEMPLATE.format("wide elements"))
+    def build():
+        table = html.Element("table")
+        for i in range(3000):
+            table.add_element("tr")
+            table.add_text("\n")
+        return table
+    def build_and_prune():
+        table = build()
+        for row in table.get_elements()[::2]:
+            table.remove_child(row)
+    bench("add_element (3000 rows)", build, 1)
+    bench("add_element, remove_child (3000 rows)", build_and_prune, 1)
+    def pop_and_query():
+        table = build()
+        for row in table.get_elements()[::-1]:
+            row.get_pre_sibling()
+            row.get_index()
+            table.remove_child(row)
+    bench("get_index, remove last row (3000 rows)", pop_and_query, 1)
+
+def bench_walk():
+    print(GROUP_TEMPLATE.format("walk"))
+    tree = html.Element.parse(_read_fixture("main.html")*10)
+    def recursive_filter(element, func):
+        found = [element] if func(element) else []
+        for child in element.get_elements():
+            found.extend(recursive_filter(child, func))
+        return found
+    bench("recursive filter (main.html x10)",
+          lambda: recursive_filter(tree, lambda e: e.name=="div"), 1)
+    bench("filter (main.html x10)", lambda: tree.filter(lambda e: e.name=="div"), 1)
+    bench("iter('div') (main.html x10)", lambda: list(tree.iter("div")), 1)
+    bench("first div from walk (main.html x10)", lambda: next(tree.iter("div")), 1)
+
+
+def bench_indexed_queries():
+    print(GROUP_TEMPLATE.format("indexed queries"))
+    tree = html.Element.parse(_read_fixture("main.html")*10)
+    for selector_string in (".slide", "div.slide-bg", "#nothing", "ul li"):
+        selector = css.Selector.parse(selector_string)
+        bench("walk '{}' (main.html x10)".format(selector_string),
+              lambda: [e for e in tree.walk() if selector.match(e)], 1)
+        bench("filter '{}' (main.html x10)".format(selector_string),
+              lambda: tree.filter(selector), 1)
+    element = tree.filter(".slide")[0]
+    def rename_and_query():
+        element.set_attribute("class", "moved")
+        tree.filter(".moved")
+        element.set_attribute("class", "slide")
+    bench("set class and filter (main.html x10)", rename_and_query, 10)
+    bench("filter('div div')[0] (main.html x10)", lambda: tree.filter("div div")[0], 1)
+    bench("query_one('div div') (main.html x10)", lambda: tree.query_one("div div"), 1)
+    bench("any(query_iter('a img')) (main.html x10)",
+          lambda: any(True for e in tree.query_iter("a img")), 1)
+
+
+def bench_fork():
+    print(GROUP_TEMPLATE.format("fork"))
+    stylesheet = css.StyleSheet.parse(_read_fixture("css/bootstrap-grid.css"))
+    def parse_and_style():
+        tree = html.Element.parse(_read_fixture("main.html"))
+        tree.apply_styles(stylesheet)
+        tree.apply_styles()
+        return tree
+    tree = parse_and_style()
+    bench("parse and style (main.html)", parse_and_style, 1)
+    bench("fork (main.html)", tree.fork, 10)
+    def fork_and_change():
+        fork = tree.fork()
+        for element in fork.query_iter("td"):
+            element.set_attribute("width", "100")
+            element.add_inline_property("color", "red")
+    bench("fork and change every td (main.html)", fork_and_change, 10)
+    def fork_and_read():
+        # what the rules in main_rules.py read from every tag
+        fork = tree.fork()
+        for element in fork.walk():
+            if element.get_styles():
+                element.get_styles().render(css.Style.INLINE)
+            if element.parent is not None:
+                element.get_parent().get_styles().has_property("mso-hide")
+    bench("fork and read every style (main.html)", fork_and_read, 1)
+
+
+def bench_tree_cache():
+    print(GROUP_TEMPLATE.format("tree cache"))
+    # main.html, styled with only bootstrap-grid.css so a full load is quick
+    # enough to repeat
+    markup = re.sub(r"<link[^>]*>", "", _read_fixture("main.html"))
+    markup = markup.replace("<head>", 
+        "<head><link rel='stylesheet' href='/css/bootstrap-grid.css'>", 1)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(temp_dir, "main.html")
+        with open(fname, "w") as f:
+            f.write(markup)
+        cache_dir = os.path.join(temp_dir, "cache")
+        def load(cache_dir=None):
+            html_page = page.HTMLPreprocessor(fname, root=FIXTURE_DIR, cache_dir=cache_dir)
+            html_page.load()
+            html_page.apply_css()
+        load(cache_dir)
+        bench("load() + apply_css() (main.html)", load, 1)
+        bench("load from cache (main.html)", lambda: load(cache_dir), 1,
+              "({} bytes)".format(sum(os.path.getsize(os.path.join(cache_dir, fname))
+                                      for fname in os.listdir(cache_dir)
+                                      if fname.endswith(".tree"))))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def bench_stylesheet_cache():
+    print(GROUP_TEMPLATE.format("StyleSheetCache"))
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for name in ("bootstrap.css", "bootstrap-grid.css"):
+            path = os.path.join(FIXTURE_DIR, "css", name)
+            text = _read_fixture(os.path.join("css", name))
+            def cold():
+                stylesheet_cache = cache.StyleSheetCache(temp_dir)
+                stylesheet_cache.max_size = 0
+                stylesheet_cache.evict()
+                stylesheet_cache.max_size = 64*1024*1024
+                stylesheet_cache.parse(path, text)
+            bench("StyleSheet.parse ({})".format(name), lambda: css.StyleSheet.parse(text), 1)
+            bench("cold cache ({})".format(name), cold, 1)
+            stylesheet_cache = cache.StyleSheetCache(temp_dir)
+            stylesheet_cache.parse(path, text)
+            bench("warm cache ({})".format(name), lambda: stylesheet_cache.parse(path, text), 1)
+
+        # a document that is not in the tree cache, but whose stylesheet is
+        markup = re.sub(r"<link[^>]*>", "", _read_fixture("main.html"))
+        markup = markup.replace("<head>", 
+            "<head><link rel='stylesheet' href='/css/bootstrap.css'>", 1)
+        fname = os.path.join(temp_dir, "main.html")
+        with open(fname, "w") as f:
+            f.write(markup)
+        cache_dir = os.path.join(temp_dir, "cache")
+        # without apply_css, no tree is stored, so only the stylesheet is cached
+        def load(cache_dir=None):
+            page.HTMLPreprocessor(fname, root=FIXTURE_DIR, cache_dir=cache_dir).load()
+        load(cache_dir)
+        bench("load() (main.html + bootstrap.css)", load, 1)
+        bench("load() with cached stylesheet", lambda: load(cache_dir), 1)
+    finally:
+        shutil.rmtree(temp_dir)
+
+def bench_stylesheet_registry():
+    print(GROUP_TEMPLATE.format("StyleSheetRegistry"))
+    temp_dir = tempfile.mkdtemp()
+    try:
+        # a batch of documents that all link to the same stylesheet
+        markup = re.sub(r"<link[^>]*>", "", _read_fixture("main.html"))
+        markup = markup.replace("<head>",
+            "<head><link rel='stylesheet' href='/css/bootstrap.css'>", 1)
+        fnames = []
+        for i in range(10):
+            fname = os.path.join(temp_dir, "page{}.html".format(i))
+            with open(fname, "w") as f:
+                f.write(markup)
+            fnames.append(fname)
+        cache_dir = os.path.join(temp_dir, "cache")
+        def load_batch(shared=True, cache_dir=None):
+            for fname in fnames:
+                if not shared:
+                    cache.STYLESHEETS.clear()
+                page.HTMLPreprocessor(fname, root=FIXTURE_DIR, cache_dir=cache_dir).load()
+        load_batch(False, cache_dir)
+        bench("load() x10, stylesheet parsed each time", lambda: load_batch(False), 1)
+        bench("load() x10, stylesheet cached on disk", lambda: load_batch(False, cache_dir), 1)
+        bench("load() x10, shared stylesheet", load_batch, 1)
+    finally:
+        cache.STYLESHEETS.clear()
+        shutil.rmtree(temp_dir)
+
+def bench_render():
+    print(GROUP_TEMPLATE.format("render"))
+    tree = html.Element.parse(_read_fixture("main.html")*10)
+    bench("recursive render (main.html x10)", lambda: legacy_render(tree), 1)
+    bench("render (main.html x10)", tree.render, 1)
+    with tempfile.TemporaryFile() as f:
+        def render_to_file():
+            f.seek(0)
+            tree.render_to(f, "utf-8")
+        bench("render_to file (main.html x10)", render_to_file, 1)
+    bench("first chunk of iter_render (main.html x10)", lambda: next(tree.iter_render()), 1)
+    rendered, minified = tree.render(), tree.render(minify=True)
+    bench("render(minify=True) (main.html x10)", lambda: tree.render(minify=True), 1,
+          "({} of {} bytes, {:.0%} smaller)".format(len(minified), len(rendered), 
+                                                   1-len(minified)/float(len(rendered))))
+    # the recursive renderer copies everything below an element once for
+    # every element above it
+    tree = html.Element.parse("<div>Lorem ipsum dolor sit amet</div>"*100)
+    for element in tree.get_elements():
+        for i in range(800):
+            element = element.add_child("div") or element.get_elements()[-1]
+            element.add_text("Lorem ipsum dolor sit amet")
+    bench("recursive render (100 x depth 800)", lambda: legacy_render(tree), 1)
+    bench("render (100 x depth 800)", tree.render, 1)
+
+
+def bench_css_tokenizer():
+    print(GROUP_TEMPLATE.format("CSSAbstract._parse_css"))
+    data = _read_fixture(os.path.join("css", "bootstrap-grid.css"))
+    rule_count = len(list(css.StyleSheet._parse_css(data)))
+    for copies in (1, 25, 120):
+        sheet = "\n".join([data]*copies)
+        rules = "{} rules".format(rule_count*copies)
+        bench("character loop ({})".format(rules), lambda: list(legacy_parse_css(sheet)), 1)
+        bench("CSS_SYNTAX ({})".format(rules),
+            lambda: list(css.StyleSheet._parse_css(sheet)), 1)
+
+
+def bench_selector_cache():
+    print(GROUP_TEMPLATE.format("Selector.parse"))
+    data = _read_fixture(os.path.join("css", "bootstrap-grid.css"))
+    selectors = [selector.strip() 
+                 for token in css.StyleSheet._parse_css(data)
+                 for selector in token.head.split(",") if not token.head.startswith("@")]
+    bench("uncached ({} selectors)".format(len(selectors)),
+        lambda: [css.Selector._parse(s) for s in selectors], 10)
+    css.static.SELECTORS.clear()
+    bench("SELECTORS ({} selectors)".format(len(selectors)),
+        lambda: [css.Selector.parse(s) for s in selectors], 10)
+    print(" |    {}".format(css.static.SELECTORS))
+    bench("StyleSheet.parse (bootstrap-grid.css)", lambda: css.StyleSheet.parse(data), 1)
+    for length in (4, 40, 200):
+        selector = " > ".join(["div.row:first-child"]*length)
+        compounds = "{} compound selectors".format(length*2)
+        bench("reparse heads ({})".format(compounds),
+            lambda: legacy_parse_selector(selector), 10)
+        bench("Selector._parse ({})".format(compounds),
+            lambda: css.Selector._parse(selector), 10)
+
+
+def run():
+    config.save()
+    config.AUTO_CLOSE_ELEMENTS = True
+
+    print(FILE_TEMPLATE.format("html.py"))
+    bench_html_parse()
+    bench_html_iterparse()
+    bench_html_parse_attributes()
+    bench_source_positions()
+    bench_interned_symbols()
+    bench_file_input()
+    bench_text_spans()
+    bench_reparse()
+    bench_node_size()
+    bench_structural_selectors()
+    bench_wide_elements()
+    bench_walk()
+    bench_indexed_queries()
+    bench_fork()
+    bench_tree_cache()
+    bench_stylesheet_cache()
+    bench_stylesheet_registry()
+    bench_render()
+
+    print(FILE_TEMPLATE.format("_abstract.py"))
+    bench_css_tokenizer()
+
+    print(FILE_TEMPLATE.format("static.py"))
+    bench_selector_cache()
+
+    config.load()
@@ -1,11 +1,18 @@
 from __future__ import print_function
 import sys,os
+import mmap
+import shutil
+import tempfile
+import threading
+import StringIO
 
+from ..css import _abstract
 from ..css import static
 from ..css.static import Style
 from ..css import dynamic
 from ..css import containers
 
+from .. import cache
 from .. import html
 from .. import page
 from .. import parser
@@ -243,6 +250,373 @@ def test_html_element(verbosity=0):
 
     config.AUTO_CLOSE_ELEMENTS=False
 
+    # nesting deeper than the recursion limit should still parse
+    depth = sys.getrecursionlimit()+100
+    element = html.Element.parse("<div>"*depth+"deep"+"</div>"*depth)
+    test(verbosity,len(element.get_elements()),1,
+        "Deeply nested elements child count")
+    innermost = element
+    while innermost.get_elements():
+        innermost = innermost.get_elements()[0]
+    test(verbosity,len(innermost.get_parents()),depth-1,
+        "Deeply nested elements depth")
+    test(verbosity,innermost.render(),"<div>deep</div>",
+        "Deeply nested elements innermost element")
+    test(verbosity,len(element.filter(lambda e: e.name=="div")),depth,
+        "Deeply nested elements filter")
+    test(verbosity,element.render(),"<div>"*depth+"deep"+"</div>"*depth,
+        "Deeply nested elements render")
+
+    # test streamed rendering
+
+    markup = "<div a='1'>Lorem<br/><p>ipsum</p></div>"
+    tree = html.Element.parse(markup)
+    test(verbosity,"".join(tree.iter_render()),tree.render(),"Iter render")
+    stream = StringIO.StringIO()
+    tree.render_to(stream)
+    test(verbosity,stream.getvalue(),tree.render(),"Render to stream")
+    tree.get_elements()[0].add_text(u"\xe9")
+    stream = StringIO.StringIO()
+    tree.render_to(stream,"utf-8")
+    test(verbosity,stream.getvalue(),tree.render().encode("utf-8"),"Render to stream encoded")
+    old_size = html.RENDER_BUFFER_SIZE
+    html.RENDER_BUFFER_SIZE = 4
+    test(verbosity,len(list(tree.iter_render()))>1,True,"Iter render yields chunks")
+    html.RENDER_BUFFER_SIZE = old_size
+
+    # test minified rendering
+
+    tree = html.Element.parse("<div>\n  <p class='a b' id='x'>  Lorem\n\t ipsum </p>\n"
+                              "  <b>x</b> <i>y</i>\n</div>")
+    test(verbosity,tree.render(minify=True),
+        '<div><p class="a b" id=x> Lorem ipsum </p> <b>x</b> <i>y</i> </div>',
+        "Minified render whitespace")
+    tree = html.Element.parse("<p><x-a>a</x-a> <x-b>b</x-b></p>\n<p><o:p>c</o:p> </p>")
+    test(verbosity,tree.render(minify=True),
+        '<p><x-a>a</x-a> <x-b>b</x-b></p><p><o:p>c</o:p> </p>',
+        "Minified render keeps whitespace next to unknown elements")
+    tree = html.Element.parse("<pre>  a\n  b </pre><textarea> c\n</textarea><script> d\n</script>")
+    test(verbosity,tree.render(minify=True),tree.render(),"Minified render preserved whitespace")
+    tree = html.Element.parse("<img src='a/b' alt=''><br/><svg><path d='M0'/></svg><p a=\"it's\"></p>")
+    test(verbosity,tree.render(minify=True),
+        '<img alt src="a/b"><br><svg><path d=M0 /></svg><p a="it\'s"></p>',
+        "Minified render attributes")
+    test(verbosity,html.Element.parse(tree.render(minify=True)).render(),tree.render(),
+        "Minified render can be parsed")
+    tree = html.Element.parse("<p title=\"abc\n\"></p>")
+    test(verbosity,html.Element.parse(tree.render(minify=True)).get_elements()[0].get_attribute("title"),
+        "abc\n","Minified render keeps a trailing newline in attributes")
+
+    # test walking the tree
+
+    tree = html.Element.parse("<div><p><b></b></p><span></span><p></p></div>")
+    test(verbosity,[e.name for e in tree.walk()],["__head__","div","p","b","span","p"],
+        "Walk pre-order")
+    test(verbosity,[e.name for e in tree.walk(html.Element.POST_ORDER)],
+        ["b","p","span","p","div","__head__"],"Walk post-order")
+    test(verbosity,len(list(tree.iter("p"))),2,"Iter by name")
+    test(verbosity,[e.name for e in tree.walk(prune=lambda e: e.name=="p")],
+        ["__head__","div","p","span","p"],"Walk pruned pre-order")
+    test(verbosity,[e.name for e in tree.walk(html.Element.POST_ORDER,prune=lambda e: e.name=="p")],
+        ["p","span","p","div","__head__"],"Walk pruned post-order")
+    test(verbosity,lambda: tree.walk("sideways"),ValueError,"Walk with unknown order")
+
+    # test the document index
+
+    tree = html.Element.parse('<div id="a"><p class="x y">1</p><p class="y"></p></div><P></P>')
+    test(verbosity,[e.name for e in tree.filter("p")],["p","p","P"],
+        "Indexed filter by tag")
+    test(verbosity,[e.get_attribute("class") for e in tree.filter(".y")],["x y","y"],
+        "Indexed filter by class")
+    test(verbosity,len(tree.get_elements()[0].filter("#a p.y")),2,
+        "Indexed filter from a child")
+    test(verbosity,tree.filter(".nothing"),[],"Indexed filter with no candidates")
+    first_p = tree.get_elements()[0].get_elements()[0]
+    first_p.set_attribute("class","z")
+    test(verbosity,(len(tree.filter(".y")),len(tree.filter(".z"))),(1,1),
+        "Indexed filter after set_attribute")
+    first_p.name = "span"
+    test(verbosity,(len(tree.filter("p")),len(tree.filter("span"))),(2,1),
+        "Indexed filter after renaming")
+    tree.get_elements()[0].remove_child(first_p)
+    tree.add_child(first_p)
+    test(verbosity,[e.name for e in tree.filter("span.z")],["span"],
+        "Indexed filter after moving an element")
+    tree.get_elements()[0].clear_children()
+    test(verbosity,(len(tree.filter("p")),tree.get_document_index().size),(1,4),
+        "Indexed filter after clearing children")
+
+    # test lazy queries
+
+    tree = html.Element.parse('<div><p class="x">1</p><b></b><p class="x">2</p></div>')
+    test(verbosity,tree.query_one("p.x"),tree.filter("p.x")[0],"Query one")
+    test(verbosity,tree.query_one("div > i"),None,"Query one with no match")
+    test(verbosity,tree.query_one(static.Selector.parse("b")).name,"b","Query one with a Selector")
+    matches = tree.query_iter(".x")
+    test(verbosity,next(matches).render(),'<p class="x">1</p>',"Query iter first match")
+    test(verbosity,len(list(matches)),1,"Query iter remaining matches")
+    test(verbosity,html.Element._get_selector("p.x") is html.Element._get_selector("p.x"),
+        True,"Query selector strings are cached")
+
+    # test mutation batches
+
+    tree = html.Element.parse("<div><p><b></b></p>x<span></span></div>")
+    div = tree.get_elements()[0]
+    visited = []
+    with tree.batch():
+        for element in tree.walk(prune=html.Element.is_detached):
+            visited.append(element.name)
+            if element.name=="p":
+                div.remove_child(element)
+                div.remove_child(div._children[1])
+                test(verbosity,(element.is_detached(),len(div.get_elements())),(True,2),
+                    "Batch removal is put off")
+                span = div.get_elements("span")[0]
+                test(verbosity,(div.has_child(element),span.get_pre_sibling() is element,
+                    span.get_index()),(True,True,1),"Batch removed elements are still found")
+    test(verbosity,visited,["__head__","div","p","span"],"Batch walk skips removed elements")
+    test(verbosity,tree.render(),"<div><span></span></div>","Batch applied on close")
+    test(verbosity,div.is_detached(),False,"Batch leaves other elements attached")
+    with tree.batch():
+        span = div.get_elements()[0]
+        div.remove_child(span)
+        tree.add_child(span)
+    test(verbosity,tree.render(),"<div></div><span></span>",
+        "Batch leaves a removed element that was moved")
+    def open_twice():
+        with tree.batch():
+            with tree.batch():
+                pass
+    test(verbosity,open_twice,ValueError,"Batch opened twice")
+    with tree.batch():
+        test(verbosity,tree._document_index,None,"Batch does not index the document")
+    test(verbosity,html.MutationBatch._open,{},"Batch closed")
+
+    # test event based parsing
+
+    events = list(html.Element.iterparse('<div a="1">Lorem<img src="x"></div> '))
+    test(verbosity,[(e.type,e.name) for e in events],
+        [("start","div"),("text",None),("start","img"),("end","img"),("end","div"),
+         ("text",None)],
+        "Iterparse event order")
+    test(verbosity,(events[0].attributes,events[2].attributes,events[2].self_closing),
+        ({"a":"1"},{"src":"x"},True),
+        "Iterparse start event attributes")
+    test(verbosity,[e.text for e in events if e.type==html.HTMLEvent.TEXT],["Lorem"," "],
+        "Iterparse text events")
+
+    config.AUTO_CLOSE_ELEMENTS=True
+    test(verbosity,[(e.type,e.name) for e in html.Element.iterparse("<div><span>")],
+        [("start","div"),("start","span"),("end","span"),("end","div")],
+        "Iterparse auto-closed end events")
+    config.AUTO_CLOSE_ELEMENTS=False
+
+    test(verbosity,lambda inpt: list(html.Element.iterparse(inpt)),
+        html.HTMLParserError,
+        "Iterparse mismatched end tag",
+        "<div></td>")
+
+    events = html.Element.iterparse("<p>Lorem</p><table><tr><td>Ipsum</td></tr></table><p></p>")
+    subtrees = [html.Element.from_events(e, events) for e in events
+                if e.type==html.HTMLEvent.START and e.name=="table"]
+    test(verbosity,[t.render() for t in subtrees],
+        ["<table><tr><td>Ipsum</td></tr></table>"],
+        "Build subtree from events")
+
+    # test parsing from files
+
+    markup = "<div>Lorem<img src='x'></div>"
+    with tempfile.TemporaryFile() as f:
+        f.write(markup)
+        f.seek(0)
+        test(verbosity,html.Element.parse(f).render(),'<div>Lorem<img src="x" /></div>',
+            "Parse from file")
+        test(verbosity,html.Element.parse(mmap.mmap(f.fileno(),0)).render(),
+            '<div>Lorem<img src="x" /></div>',"Parse from mmap")
+    with tempfile.TemporaryFile() as f:
+        f.write("<br>"+markup)
+        f.seek(4)
+        test(verbosity,html.Element.parse(f).render(),'<div>Lorem<img src="x" /></div>',
+            "Parse from part read file")
+    with tempfile.TemporaryFile() as f:
+        test(verbosity,html.Element.parse(f).render(),"","Parse from empty file")
+    with tempfile.TemporaryFile() as f:
+        f.write(markup)
+        f.seek(0)
+        small_tree = html.Element.parse(f)
+        f.seek(0)
+        html.Element.MMAP_MIN_SIZE, min_size = 0, html.Element.MMAP_MIN_SIZE
+        try:
+            tree = html.Element.parse(f)
+        finally:
+            html.Element.MMAP_MIN_SIZE = min_size
+        text = tree.get_elements("div")[0]._children[0]
+        test(verbosity,(isinstance(small_tree.get_elements("div")[0]._children[0]._buffer,mmap.mmap),
+            isinstance(text._buffer,mmap.mmap)),(False,True),"Only large files are memory mapped")
+        tree.release_source()
+        f.seek(0)
+        f.truncate()
+        test(verbosity,(isinstance(text._buffer,mmap.mmap),tree.render()),
+            (False,'<div>Lorem<img src="x" /></div>'),"Release memory mapped source")
+        tree.reparse(5,10,"Ipsum")
+        test(verbosity,tree.render(),'<div>Ipsum<img src="x" /></div>',
+            "Reparse after releasing source")
+    test(verbosity,[e.type for e in html.Element.iterparse(StringIO.StringIO(markup))],
+        ["start","text","start","end","end"],"Iterparse from file-like object")
+
+    # test text backed by source spans
+
+    markup = "<p> Lorem <b>ipsum</b>\n\t</p>"
+    tree = html.Element.parse(markup)
+    text = tree.get_elements("p")[0]._children[0]
+    test(verbosity,(text._buffer is markup,text.text),(True," Lorem "),
+        "Text element reads from source span")
+    test(verbosity,[child.get_empty() for child in tree.get_elements("p")[0]._children],
+        [False,False,True],"Empty text spans")
+    text.text = "dolor"
+    test(verbosity,(text._buffer,tree.render()),(None,"<p>dolor<b>ipsum</b>\n\t</p>"),
+        "Setting text on span backed element")
+    test(verbosity,html.TextElement.from_span("<p>sit</p>",3,6).render(),"sit",
+        "Text element from span")
+
+    # test incremental reparsing
+
+    markup = "<div><p>Lorem <b>ipsum</b></p><span>dolor</span></div>"
+    tree = html.Element.parse(markup)
+    div = tree.get_elements("div")[0]
+    span = div.get_elements("span")[0]
+    span.styles = "kept"
+    changed = tree.reparse(markup.index("ipsum"),markup.index("ipsum")+5,"<i>sit</i>")
+    test(verbosity,(changed.name,tree.render()),
+        ("b","<div><p>Lorem <b><i>sit</i></b></p><span>dolor</span></div>"),
+        "Reparse inside an element")
+    test(verbosity,(tree.get_elements("div")[0] is div,div.get_elements("span")[0] is span,
+        span.styles),(True,True,"kept"),"Reparse keeps unaffected elements")
+    test(verbosity,(span.get_source_span(),span._children[0].text),((35,53),"dolor"),
+        "Reparse moves source offsets")
+    markup = tree._source.text
+    changed = tree.reparse(markup.index("</b>"),markup.index("</b>"),"</b><b>")
+    test(verbosity,(changed.name,tree.render()),
+        ("p","<div><p>Lorem <b><i>sit</i></b><b></b></p><span>dolor</span></div>"),
+        "Reparse widens when the edit closes its element")
+    test(verbosity,lambda: tree.reparse(0,0,"</td>"),html.HTMLParserError,
+        "Reparse with invalid markup")
+    test(verbosity,tree.render(),"<div><p>Lorem <b><i>sit</i></b><b></b></p><span>dolor</span></div>",
+        "Tree is unchanged after failed reparse")
+
+    # test referencing children as attributes
+
+    tree = html.Element.parse("<div><span></span><span></span></div>")
+    config.REFERENCE_ELEMENTS_AS_ATTRIBUTES=True
+    test(verbosity,len(tree.div[0].span),2,"Reference children as attributes")
+    test(verbosity,lambda: tree.div[0].img,AttributeError,"Reference missing child")
+    config.REFERENCE_ELEMENTS_AS_ATTRIBUTES=False
+    test(verbosity,lambda: tree.div,AttributeError,"Reference children when disabled")
+    test(verbosity,hasattr(tree,"__dict__"),False,"Elements have no __dict__")
+
+    # test lazily created styles
+
+    tree = html.Element.parse("<div style='color:red'>Lorem</div>")
+    div = tree.get_elements("div")[0]
+    test(verbosity,(div._styles,div._inline_style,div.has_styles()),(None,None,False),
+        "Styles are not created by parsing")
+    tree.apply_styles()
+    test(verbosity,(div.has_styles(),div._children[0]._styles),(True,None),
+        "Styles are created when applied")
+    tree.reset_styles()
+    test(verbosity,(div.has_styles(),div.styles.render()),(False,""),"Reset styles")
+
+    # test forking
+
+    tree = html.Element.parse("<div class='a' style='color:red'>Lorem<b>ipsum</b></div>")
+    tree.apply_styles()
+    fork = tree.fork()
+    div, forked_div = tree.get_elements()[0], fork.get_elements()[0]
+    test(verbosity,(fork.render(),forked_div is div),(tree.render(),False),"Fork copies the tree")
+    test(verbosity,(forked_div._attributes is div._attributes,forked_div._styles is div._styles),
+        (True,True),"Fork shares attributes and styles")
+    forked_div.set_attribute("class","b")
+    forked_div.add_inline_property("margin","0")
+    forked_div.get_elements()[0].remove()
+    test(verbosity,(div.get_attribute("class"),bool(div._inline_style.has_property("margin")),
+        len(div.get_elements())),("a",False,1),"Fork changes leave the original alone")
+    div.apply_styles(containers.StyleSheet.parse("div{padding:0}"))
+    test(verbosity,(div.styles.has_property("padding"),forked_div.styles.has_property("padding")),
+        (True,False),"Original changes leave the fork alone")
+
+    # reading styles, as the rules in main_rules.py do for every tag, does
+    # not copy them
+    fork = tree.fork()
+    for element in fork.walk():
+        if element.get_styles():
+            element.get_styles().render(Style.INLINE)
+        if element.parent is not None:
+            element.get_parent().get_styles().has_property("mso-hide")
+    test(verbosity,all(forked._styles is element._styles 
+        for forked, element in zip(fork.walk(), tree.walk())),True,
+        "Fork shares styles that are only read")
+
+    # changing the styles of a fork in place leaves the original alone
+    tree = html.Element.parse("<p>Lorem</p>")
+    tree.apply_styles(containers.StyleSheet.parse("p{margin:0}"))
+    fork = tree.fork()
+    fork.get_elements()[0].styles.merge(Style.parse("p{padding:5px}"))
+    test(verbosity,(tree.get_elements()[0].styles.render(Style.INLINE),
+        fork.get_elements()[0].styles.render(Style.INLINE)),
+        ("margin:0;","margin:0;padding:5px;"),"Fork styles changed in place")
+
+    # every slot is set on a fork
+    def get_unset_slots(element):
+        return [slot for klass in type(element).__mro__
+                for slot in klass.__dict__.get("__slots__", ())
+                if not hasattr(element, slot)]
+    forked_div = tree.fork().get_elements()[0]
+    test(verbosity,(get_unset_slots(forked_div),get_unset_slots(forked_div._children[0])),
+        ([],[]),"Fork sets every slot")
+
+    # test serializing
+
+    tree = html.Element.parse("<div class='a' style='color:red'>Lorem<br/><b>ipsum</b></div>")
+    tree.apply_styles()
+    loaded = html.Element.deserialize(tree.serialize())
+    test(verbosity,loaded.render(),tree.render(),"Serialized tree")
+    test(verbosity,loaded.get_elements()[0].styles.render(),
+        tree.get_elements()[0].styles.render(),"Serialized tree styles")
+    test(verbosity,[e._self_closing for e in loaded.walk()],[e._self_closing for e in tree.walk()],
+        "Serialized tree self-closing flags")
+    test(verbosity,loaded.query_one("b").name,"b","Serialized tree query")
+
+    # styles are matched in the order they appear in, so the result does not
+    # depend on where the stylesheet came from
+    stylesheet = containers.StyleSheet.parse("b {x:1}\n.a {y:2}\nb.a {z:3}\n* {w:4}")
+    element = html.Element.parse("<b class='a'></b>").get_elements()[0]
+    test(verbosity,[style.properties[0].name for style in stylesheet.match(element)],
+        ["x", "y", "z", "w"], "Match styles in stylesheet order")
+    test(verbosity,[p.name for p in static.Style.parse("p {margin:0;color:red}").get_copy().properties],
+        ["margin", "color"], "Style copy keeps properties that are not inherited")
+
+    # test source positions
+
+    tree = html.Element.parse("<div>\n  <span a=1>Lorem</span>\n<img></div>")
+    span = tree.get_elements("div")[0].get_elements("span")[0]
+    test(verbosity,(span.get_source_span(),span.get_source_position()),((8,30),(2,3)),
+        "Element source span and position")
+    test(verbosity,span._children[0].get_source_position(),(2,13),
+        "Text source position")
+    test(verbosity,tree.get_elements("div")[0].get_elements("img")[0].get_source_span(),
+        (31,36),"Void element source span")
+    test(verbosity,html.Element("div").get_source_position(),None,
+        "Unparsed element source position")
+
+    try:
+        html.Element.parse("<div>\n\t</td>")
+    except html.HTMLParserError as e:
+        error = str(e)
+    else:
+        error = None
+    test(verbosity,bool(error) and error.startswith("Unexpected end element on line 2, col 2."),
+        True,"Mismatched end tag error position")
+
     # test the get_[[relation]] methods for elements
     
     tree = html.Element.parse("<div><tr></tr><td><span></span></td><img><a></a></div>")
@@ -306,6 +680,46 @@ def test_html_element(verbosity=0):
     test(verbosity, tree.get_elements("div")[0].get_elements("a")[0].get_parent(),
         tree.get_elements("div")[0],"Element parent (last child)")
 
+    div = tree.get_elements("div")[0]
+    test(verbosity, [e.get_index() for e in div.get_elements()], [0,1,2,3],
+        "Element indexes")
+    test(verbosity, (div.get_elements("td")[0].get_pre_sibling().name,
+        div.get_elements("td")[0].get_post_sibling().name), ("tr","img"),
+        "Element adjacent siblings")
+    test(verbosity, (div.get_elements("tr")[0].get_pre_sibling(),
+        div.get_elements("a")[0].get_post_sibling()), (None,None),
+        "Element adjacent siblings (first and last child)")
+    div.insert_child(html.Element("td"),0)
+    test(verbosity, ([e.get_index() for e in div.get_elements()],
+        [e.get_index(True) for e in div.get_elements("td")],div.get_element_count("td")),
+        ([0,1,2,3,4],[0,1],2),"Element indexes after insert")
+    removed = div.get_elements("tr")[0]
+    div.remove_child(removed)
+    test(verbosity, ([e.get_index() for e in div.get_elements()],removed.get_index()),
+        ([0,1,2,3],None),"Element indexes after removal")
+    div.get_elements("img")[0].name = "td"
+    test(verbosity, [e.get_index(True) for e in div.get_elements("td")],[0,1,2],
+        "Element indexes after rename")
+
+    # the cached positions are kept up to date by inserts and removals
+    div = html.Element.parse("<div>"+"<p></p><b></b>text"*4+"</div>").get_elements("div")[0]
+    elements = div._get_element_list()
+    positions = []
+    for i in range(12):
+        if i%3==0:
+            div.remove_child(div.get_elements()[-1])
+        elif i%3==1:
+            div.insert_before("b" if i%2 else "p", div.get_elements()[i%len(div.get_elements())])
+        else:
+            div.remove_child(div.get_elements()[i%len(div.get_elements())])
+        positions.append([(e.get_index(), e.get_index(True)) for e in div.get_elements()])
+    fresh = html.Element.parse(div.render()).get_elements("div")[0]
+    test(verbosity, (positions[-1], div._get_element_list() is elements),
+        ([(e.get_index(), e.get_index(True)) for e in fresh.get_elements()], True),
+        "Element indexes after mixed inserts and removals")
+    test(verbosity, [e.name for e in div.get_elements("b")], ["b"]*fresh.get_element_count("b"),
+        "Elements by name after mixed inserts and removals")
+
     # test child addition/removal methods
     
     tree = html.Element.parse("<div></div>")
@@ -346,6 +760,22 @@ def test_html_element(verbosity=0):
         "Add child with attributes")
     tree.get_elements("div")[0].clear_children()
 
+    div = tree.get_elements("div")[0]
+    div.add_element("span")
+    span = div.get_elements("span")[0]
+    div.insert_before("a",span)
+    div.insert_after("b",span)
+    span.add_pre_sibling("i")
+    span.add_post_sibling("u")
+    test(verbosity, tree.render(),"<div><a></a><i></i><span></span><u></u><b></b></div>",
+        "Insert before and after")
+    span.remove()
+    div.get_elements("a")[0].remove()
+    test(verbosity, (tree.render(),span.get_pre_sibling(),div.get_elements("i")[0].get_pre_sibling()),
+        ("<div><i></i><u></u><b></b></div>",None,None),"Remove elements")
+    test(verbosity, lambda: div.remove_child(span),ValueError,"Remove missing child")
+    div.clear_children()
+
     # test empty methods
 
     test(verbosity, tree.get_elements("div")[0].get_empty(),True,
@@ -562,6 +992,117 @@ def test_html_element(verbosity=0):
         "Attribute with missing close quotes",
         "<div attr1='Lorem></div>")
 
+    # test interned names
+
+    tree = html.Element.parse('<DIV class="a b"></DIV><div class="b"></div>')
+    first, second = tree.get_elements()
+    test(verbosity,(first.tag_name is second.tag_name, first.tag_name, first.name),
+        (True,"div","DIV"),
+        "Interned tag names")
+    test(verbosity,(_abstract.intern_symbol("".join(["d","iv"])) is "div",
+        _abstract.intern_symbol(u"\xfcber")),(True,u"\xfcber"),"Interned non-ascii names")
+    test(verbosity,bool(static.Element(u"\xfcber",static.Element.ELEMENT).match(
+        html.Element(u"\xfcber"))),True,"Match non-ascii tag names")
+    test(verbosity,first.get_classes(),frozenset(["a","b"]),
+        "Element classes")
+    second.set_attribute("class","c  d")
+    test(verbosity,second.get_classes(),frozenset(["c","","d"]),
+        "Element classes after setting class attribute")
+    test(verbosity,[e.name for e in tree.filter("div.b")],["DIV"],
+        "Selector match on interned names")
+
+    # test the attribute parser directly
+
+    test(verbosity, html.Element._parse_attributes('a b=c d = "e f" g=\'"h"\''),
+        {"a":"","b":"c","d":"e f","g":'"h"'},
+        "Parse attribute string")
+
+    test(verbosity, html.Element._parse_attributes('a="Lorem ipsum '),
+        {"a":"Lorem ipsum"},
+        "Parse attribute string with unterminated string")
+
+    test(verbosity, html.Element._parse_attributes,
+        html.HTMLParserError,
+        "Parse attribute string with repeated '='",
+        "a==b")
+
+    test(verbosity, html.Element._parse_attributes,
+        html.HTMLParserError,
+        "Parse attribute string with string before name",
+        'a "b"')
+
+    test(verbosity, html.Element._parse_attributes,
+        html.HTMLParserError,
+        "Parse attribute string with invalid character",
+        "a=b`c")
+
+
+def test_css_tokenizer(verbosity=0):
+    print(GROUP_TEMPLATE.format("CSSAbstract._parse_css"))
+
+    def tokenize(inpt):
+        return [(t.head, t.tail, t.is_block) for t in containers.StyleSheet._parse_css(inpt)]
+
+    test(verbosity,tokenize("\n a { color:red; }\n\nb>c{margin:0}\n"),
+        [("a", "color:red;", True), ("b>c", "margin:0", True)],
+        "Tokenize styles")
+
+    test(verbosity,tokenize("@import url(a.css); @import url(b.css);\na{b:c}"),
+        [("@import url(a.css)", "", False), ("@import url(b.css)", "", False),
+         ("a", "b:c", True)],
+        "Tokenize at-rules")
+
+    test(verbosity,tokenize("@media screen { a { b:c } d{e:f} } g{h:i}"),
+        [("@media screen", "a { b:c } d{e:f}", True), ("g", "h:i", True)],
+        "Tokenize nested blocks")
+
+    test(verbosity,tokenize("/* a{b:c} */a/* ; */{b:/* } */c}/**/d{}"),
+        [("a", "b:c", True), ("d", "", True)],
+        "Tokenize comments")
+
+    test(verbosity,tokenize("a[title='{;']{content:\"} /*\"}b{content:'\\''}"),
+        [("a[title='{;']", "content:\"} /*\"", True), ("b", "content:'\\''", True)],
+        "Tokenize strings")
+
+    test(verbosity,tokenize("a{b:c} d{e:f"),
+        [("a", "b:c", True), ("d", "e:f", True)],
+        "Tokenize unclosed block")
+
+    tokens = list(containers.StyleSheet._parse_css("a{b:c}\n/* x */ d { e:f }"))
+    test(verbosity,[t.text for t in tokens], ["a{b:c}", "/* x */ d { e:f }"],
+        "Tokens keep their source text")
+
+
+def test_css_instance_numbers(verbosity=0):
+    print(GROUP_TEMPLATE.format("reserve_instance_numbers"))
+
+    first = _abstract.reserve_instance_numbers(3)
+    test(verbosity,(_abstract.reserve_instance_numbers(0),static.Style.parse("a{}")._instance_no),
+        (first+3,first+3),"Reserve instance numbers")
+    minimum = first+100
+    test(verbosity,(_abstract.reserve_instance_numbers(0,minimum),
+        _abstract.reserve_instance_numbers(1)),(minimum,minimum),
+        "Reserve instance numbers from a minimum")
+
+    ranges = []
+    def reserve_all():
+        for i in range(20000):
+            ranges.append(_abstract.reserve_instance_numbers(3))
+    # switching threads as often as possible makes any overlap show up
+    check_interval = sys.getcheckinterval()
+    sys.setcheckinterval(1)
+    try:
+        threads = [threading.Thread(target=reserve_all) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setcheckinterval(check_interval)
+    numbers = [first+i for first in ranges for i in range(3)]
+    test(verbosity,len(set(numbers)),len(ranges)*3,
+        "Reserve instance numbers from several threads")
+
 
 def test_static_property(verbosity=0):
     print(GROUP_TEMPLATE.format("Property"))
@@ -730,11 +1271,283 @@ def test_static_property(verbosity=0):
         "Merge inherited Property with non-matching Property (src)")
 
 
+def test_static_selector(verbosity=0):
+    print(GROUP_TEMPLATE.format("Selector"))
+
+    selector = static.Selector._parse("ul > li.item:first-child")
+    test(verbosity,(selector.render(), selector.conn_type, selector.head.conn_type),
+        ("ul>li.item:first-child", static.Selector.HAS_ALSO, static.Selector.HAS_DIRECT_CHILD),
+        "Parse compound selector")
+
+    selector = static.Selector._parse("a b+c~d")
+    test(verbosity,[s.conn_type for s in (selector, selector.head, selector.head.head)],
+        [static.Selector.HAS_FOLLOWING_SIBLINGS, static.Selector.HAS_NEXT_SIBLING,
+         static.Selector.HAS_CHILD],
+        "Parse combinators")
+
+    test(verbosity,static.Selector._parse("div:not(.a)\n\tp").render(), "div:not(.a) p",
+        "Parse pseudo-class with argument")
+
+    test(verbosity,static.Selector._parse, _abstract.CSSParserError,
+        "Parse unclosed parenthesis",
+        "a:not(.b")
+
+    test(verbosity,static.Selector._parse, _abstract.CSSParserError,
+        "Parse empty selector",
+        "  ")
+
+    # every thread parses the same selectors, and should get the same results
+    # as parsing them one after the other
+    selectors = ["ul > li:first-child", "a:hover ~ p:last-child", ".a:empty + #b",
+                 "div:last-child:not(.x) > span:only-of-type", "td>img:first-child"]
+    expected = [static.Selector._parse(s).render() for s in selectors]
+    results = []
+    def parse_all():
+        for i in range(200):
+            results.append([static.Selector._parse(s).render() for s in selectors])
+    # switching threads as often as possible makes any shared state show up
+    check_interval = sys.getcheckinterval()
+    sys.setcheckinterval(1)
+    try:
+        threads = [threading.Thread(target=parse_all) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setcheckinterval(check_interval)
+    test(verbosity,all(result==expected for result in results) and len(results)==800, True,
+        "Parse selectors from several threads")
+
+
+def test_static_selector_cache(verbosity=0):
+    print(GROUP_TEMPLATE.format("SelectorCache"))
+
+    cache = static.SelectorCache(2)
+    first = cache.get("div  >\n p")
+    test(verbosity,(cache.get("div > p") is first, cache.hits, cache.misses), (True, 1, 1),
+        "Reuse selectors with different whitespace")
+    test(verbosity,first==static.Selector._parse("div > p"), True,
+        "Cached selector matches parsed selector")
+
+    cache.get("a")
+    cache.get("div > p")
+    cache.get("b")
+    test(verbosity,(cache.get("div > p") is first, len(cache), cache.misses), (True, 2, 3),
+        "Drop least recently used selector")
+
+    cache.clear()
+    test(verbosity,(len(cache), cache.hits, cache.misses), (0, 0, 0),
+        "Clear selector cache")
+
+    test(verbosity,static.Selector.parse(".a .b") is static.Selector.parse(" .a  .b "), True,
+        "Selector.parse shares selectors")
+    test(verbosity,static.Style.parse(".a .b {}").selector is static.Selector.parse(".a .b"),
+        True, "Style.parse shares selectors")
+
+
 def test_static_attribute_filter(verbosity=0):
     print(GROUP_TEMPLATE.format("AttributeFilter"))
     # test parsing and rendering
 
 
+def test_tree_cache(verbosity=0):
+    print(GROUP_TEMPLATE.format("TreeCache"))
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(cache_dir,"page.html"),"w") as f:
+            f.write("<link rel='stylesheet' href='page.css'><p>Lorem</p>")
+        with open(os.path.join(cache_dir,"page.css"),"w") as f:
+            f.write("p {color:red}")
+        def load_page():
+            html_page = page.HTMLPreprocessor("page.html",root=cache_dir,
+                cache_dir=os.path.join(cache_dir,"cache")).load()
+            html_page.apply_css()
+            return html_page
+        first_page = load_page()
+        second_page = load_page()
+        test(verbosity,(first_page._cached,second_page._cached),(False,True),
+            "Tree cache hit")
+        test(verbosity,second_page.element_tree.get_elements("p")[0].styles.render(),
+            first_page.element_tree.get_elements("p")[0].styles.render(),
+            "Tree cache styles")
+        with open(os.path.join(cache_dir,"page.css"),"w") as f:
+            f.write("p {color:blue}")
+        test(verbosity,load_page()._cached,False,"Tree cache stylesheet changed")
+        test(verbosity,(second_page.stylesheets,first_page.stylesheets!=[]),([],True),
+            "Tree cache hit reads no stylesheets")
+
+        # the styles of a cached tree may hold nth-child equations
+        with open(os.path.join(cache_dir,"page.html"),"w") as f:
+            f.write("<link rel='stylesheet' href='page.css'><ul><li>a</li><li>b</li></ul>")
+        with open(os.path.join(cache_dir,"page.css"),"w") as f:
+            f.write("li:nth-child(2n+1) {color:red}")
+        first_page = load_page()
+        second_page = load_page()
+        test(verbosity,(second_page._cached,[li.styles.render(Style.INLINE) 
+            for li in second_page.element_tree.query_iter("li")]),(True,["color:red;",""]),
+            "Tree cache nth-child styles")
+
+        # an entry pickled with classes that have since changed is a miss
+        tree_cache = cache.TreeCache(os.path.join(cache_dir,"cache"))
+        with open(tree_cache._get_path("stale"),"wb") as f:
+            f.write(tree_cache.MAGIC)
+            f.write("cmagnolia.html\nNoSuchClass\n.")
+        test(verbosity,tree_cache.load("stale"),None,"Tree cache stale entry")
+        key = cache.TreeCache.get_key("<p></p>")
+        cache.TreeCache.VERSION, version = cache.TreeCache.VERSION-1, cache.TreeCache.VERSION
+        try:
+            old_key = cache.TreeCache.get_key("<p></p>")
+        finally:
+            cache.TreeCache.VERSION = version
+        test(verbosity,old_key!=key,True,"Tree cache key changes with version")
+    finally:
+        cache.STYLESHEETS.discard(os.path.join(cache_dir,"page.css"))
+        shutil.rmtree(cache_dir)
+
+
+def test_stylesheet_cache(verbosity=0):
+    print(GROUP_TEMPLATE.format("StyleSheetCache"))
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        css_path = os.path.join(cache_dir,"page.css")
+        css_text = "li:nth-child(2n) {color:red}\n@media screen { p {margin:0} }"
+        with open(css_path,"w") as f:
+            f.write(css_text)
+        stylesheet_cache = cache.StyleSheetCache(os.path.join(cache_dir,"sheets"))
+        key = stylesheet_cache.get_key(css_path, css_text)
+        test(verbosity,stylesheet_cache.load(key),None,"Stylesheet cache miss")
+        parsed = stylesheet_cache.parse(css_path, css_text)
+        loaded = stylesheet_cache.load(key)
+        test(verbosity,loaded.render(),parsed.render(),"Stylesheet cache hit")
+        tree = html.Element.parse("<ul><li>a</li><li>b</li></ul>")
+        test(verbosity,[bool(loaded.match(li)) for li in tree.get_elements("ul")[0].get_elements()],
+            [False, True], "Stylesheet cache equations")
+        test(verbosity,min(item._instance_no for item in loaded._items)>parsed._instance_no,
+            True, "Stylesheet cache orders loaded styles after existing ones")
+        test(verbosity,stylesheet_cache.get_key(css_path, css_text+" ")!=key,True,
+            "Stylesheet cache key changes with content")
+
+        with open(stylesheet_cache._get_path("stale"),"wb") as f:
+            f.write(stylesheet_cache.MAGIC)
+            f.write("cmagnolia.css\nNoSuchClass\n.")
+        test(verbosity,stylesheet_cache.load("stale"),None,"Stylesheet cache stale entry")
+
+        stylesheet_cache.max_size = 0
+        stylesheet_cache.evict()
+        test(verbosity,os.listdir(stylesheet_cache.directory),[],"Stylesheet cache eviction")
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_stylesheet_registry(verbosity=0):
+    print(GROUP_TEMPLATE.format("StyleSheetRegistry"))
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        css_path = os.path.join(cache_dir,"page.css")
+        with open(css_path,"w") as f:
+            f.write("* {margin:0}\np {color:red}\n@media screen { p {padding:0} }")
+        registry = cache.StyleSheetRegistry()
+        stylesheet, content_hash = registry.get(css_path)
+        test(verbosity,registry.get(os.path.join(cache_dir,".","page.css")),
+            (stylesheet, content_hash),"Stylesheet registry hit")
+        test(verbosity,(registry.hits,registry.misses),(1,1),"Stylesheet registry counts")
+        os.utime(css_path,(0,0))
+        test(verbosity,registry.get(css_path)[0] is stylesheet,False,
+            "Stylesheet registry reparses changed files")
+        test(verbosity,registry.get,IOError,"Stylesheet registry missing file",
+            os.path.join(cache_dir,"missing.css"))
+        crlf_path = os.path.join(cache_dir,"crlf.css")
+        with open(crlf_path,"wb") as f:
+            f.write("p {color:red}\r\nb {margin:0}\r\n")
+        test(verbosity,(registry.get(crlf_path)[1],registry.get(crlf_path)[0].render()),
+            (cache.TreeCache.get_file_hash(crlf_path),
+             containers.StyleSheet.parse("p {color:red}\nb {margin:0}\n").render()),
+            "Stylesheet registry hashes the bytes of the file")
+
+        results = []
+        def get_stylesheet():
+            results.append(registry.get(css_path)[0].render())
+        threads = [threading.Thread(target=get_stylesheet) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        test(verbosity,results,[stylesheet.render()]*8,"Stylesheet registry threads")
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_html_preprocessor(verbosity=0):
+    print(GROUP_TEMPLATE.format("HTMLPreprocessor"))
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(cache_dir,"page.css"),"w") as f:
+            f.write("* {margin:0}\np {color:red}\n@media screen { p {padding:0} }")
+        with open(os.path.join(cache_dir,"page.html"),"w") as f:
+            f.write("<link rel='stylesheet' href='page.css'><p>Lorem</p><b>ipsum</b>")
+        pages = [page.HTMLPreprocessor("page.html",root=cache_dir).load() for i in range(2)]
+        shared = pages[0].stylesheets[0]
+        before = [style.render() for styles in shared._style_map.values() for style in styles]
+        for html_page in pages:
+            html_page.apply_css()
+        test(verbosity,pages[1].stylesheets[0] is shared,True,
+            "Stylesheet registry shared between HTMLPreprocessors")
+        test(verbosity,[style.render() for styles in shared._style_map.values() for style in styles],
+            before,"Shared stylesheets are not changed by apply_css")
+        test(verbosity,pages[1].element_tree.get_elements("b")[0].styles.render(Style.INLINE),
+            "margin:0;","Shared stylesheet styles are not mixed together")
+
+        # each document cascades in its own link order, whichever document
+        # parsed the shared stylesheets first
+        with open(os.path.join(cache_dir,"red.css"),"w") as f:
+            f.write(".d {color:red}")
+        with open(os.path.join(cache_dir,"blue.css"),"w") as f:
+            f.write(".c {color:blue}")
+        for name, links in (("first.html", ("blue.css", "red.css")),
+                            ("second.html", ("red.css", "blue.css"))):
+            with open(os.path.join(cache_dir,name),"w") as f:
+                f.write("".join("<link rel='stylesheet' href='{}'>".format(link) for link in links))
+                f.write("<p class='c d'>Lorem</p>")
+        results = []
+        for name in ("first.html", "second.html"):
+            html_page = page.HTMLPreprocessor(name,root=cache_dir).load()
+            html_page.apply_css()
+            results.append(html_page.element_tree.get_elements("p")[0].styles.render(Style.INLINE))
+        test(verbosity,results,["color:red;", "color:blue;"],
+            "Shared stylesheets follow each document's link order")
+    finally:
+        for name in ("page.css", "red.css", "blue.css"):
+            cache.STYLESHEETS.discard(os.path.join(cache_dir,name))
+        shutil.rmtree(cache_dir)
+
+    # documents that are not in the tree cache still share stylesheets
+    cache_dir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(cache_dir,"page.css"),"w") as f:
+            f.write("li:nth-child(2n) {color:red}\n@media screen { p {margin:0} }")
+        for name in ("first.html", "second.html"):
+            with open(os.path.join(cache_dir,name),"w") as f:
+                f.write("<link rel='stylesheet' href='page.css'><ul><li>{}</li></ul>".format(name))
+        pages = []
+        for name in ("first.html", "second.html"):
+            html_page = page.HTMLPreprocessor(name,root=cache_dir,
+                cache_dir=os.path.join(cache_dir,"cache")).load()
+            html_page.apply_css()
+            pages.append(html_page)
+        test(verbosity,len(os.listdir(os.path.join(cache_dir,"cache","stylesheets"))),1,
+            "Stylesheet cache shared between documents")
+        test(verbosity,pages[1].stylesheets[0].render(),pages[0].stylesheets[0].render(),
+            "Stylesheet cache used by HTMLPreprocessor")
+    finally:
+        cache.STYLESHEETS.discard(os.path.join(cache_dir,"page.css"))
+        shutil.rmtree(cache_dir)
+
+
 def run():
     verbosity=0
 
@@ -744,8 +1557,22 @@ def run():
     test_html_element(verbosity)
 
     #this should test html before css
+    print(FILE_TEMPLATE.format("_abstract.py"))
+    test_css_tokenizer(verbosity)
+    test_css_instance_numbers(verbosity)
+
     print(FILE_TEMPLATE.format("static.py"))
     test_static_property(verbosity)
+    test_static_selector(verbosity)
+    test_static_selector_cache(verbosity)
     test_static_attribute_filter(verbosity)
 
+    print(FILE_TEMPLATE.format("cache.py"))
+    test_tree_cache(verbosity)
+    test_stylesheet_cache(verbosity)
+    test_stylesheet_registry(verbosity)
+
+    print(FILE_TEMPLATE.format("page.py"))
+    test_html_preprocessor(verbosity)
+
     config.load()
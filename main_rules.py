@@ -75,9 +75,9 @@ def url_worker(queue):
 
 @main.html_rule()
 def validate_styles(tag):
-    if tag.styles:
-        used_styles.merge(tag.styles)
-    if tag.has_parent() and tag.get_parent().styles.has_property("mso-hide"):
+    if tag.get_styles():
+        used_styles.merge(tag.get_styles())
+    if tag.has_parent() and tag.get_parent().get_styles().has_property("mso-hide"):
         tag.add_inline_property("mso-hide",tag.parent.get_property("mso-hide"))
 
 @main.html_rule()
@@ -97,8 +97,8 @@ def validate_urls(tag):
 
 @main.html_rule()
 def make_styles_inline(tag):
-    if tag.styles:
-        tag.set_attribute("style",tag.styles.render(Style.INLINE))
+    if tag.get_styles():
+        tag.set_attribute("style",tag.get_styles().render(Style.INLINE))
 
 @main.html_rule("td>img")
 def check_img_gaps(tag):